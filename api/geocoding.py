@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+The lookups behind request_geonames: GeoNames place search, Raw Data API
+countries ("hdx <name>") and OSM elements ("osm <id>"), and Tasking Manager
+projects ("tm <id>"). A query without a prefix goes to GeoNames and to the
+other lookups that can answer it. Lookups run on pooled sessions in a shared
+thread pool, and their results are cached in Redis by normalized query. A
+search answers after DEADLINE seconds with the lookups done by then.
+
+Lookups answer like GeoNames: {"totalResultsCount": n, "geonames": [results]}.
+"""
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import redis
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from utils.redis_client import get_client
+
+LOG = logging.getLogger(__name__)
+
+CACHE_KEY = "geocode:v2:{0}:{1}"
+CACHE_TTL = 3600
+# (connect, read) seconds of each upstream request
+TIMEOUT = (3, 10)
+DEADLINE = 5
+
+
+def make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+session = make_session()
+# lookups still running at the deadline finish here, and are cached
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="geocode")
+
+
+def normalize(query):
+    return " ".join((query or "").split()).lower()
+
+
+def get_json(url, **params):
+    r = session.get(url, params=params, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
+
+def answer(results, total=None):
+    return {
+        "totalResultsCount": len(results) if total is None else total,
+        "geonames": results,
+    }
+
+
+def boundary(geometry, **fields):
+    """A result whose boundary is geometry."""
+    return dict(
+        bbox={
+            "type": "FeatureCollection",
+            "features": [{"type": "Feature", "properties": {}, "geometry": geometry}],
+        },
+        **fields
+    )
+
+
+def geonames(query):
+    response = get_json(
+        settings.GEONAMES_API_URL,
+        maxRows=20,
+        username="osm_export_tool",
+        style="full",
+        q=query,
+    )
+    # the upstream total counts every match, not only the maxRows returned
+    return answer(response.get("geonames", []), response.get("totalResultsCount"))
+
+
+def hdx_countries(name):
+    url = "{0}v1/countries/".format(settings.RAW_DATA_API_URL)
+    features = get_json(url, q=name)["features"]
+    return answer(
+        [
+            boundary(
+                feature["geometry"],
+                adminName2="ISO3 : {0}".format(feature["properties"]["iso_3"]),
+                countryName=feature["properties"]["name"],
+                adminName1=feature["properties"]["cid"],
+            )
+            for feature in features
+        ]
+    )
+
+
+def osm_element(osm_id):
+    url = "{0}v1/osm_id/".format(settings.RAW_DATA_API_URL)
+    features = get_json(url, osm_id=osm_id)["features"]
+    return answer(
+        [
+            boundary(
+                feature["geometry"],
+                adminName2="OSM",
+                countryName=int(osm_id),
+                adminName1="Element",
+            )
+            for feature in features
+        ]
+    )
+
+
+def tm_project(project_id):
+    project = get_json("{0}/{1}/".format(settings.TASKING_MANAGER_API_URL, project_id))
+    if "areaOfInterest" not in project:
+        return answer([])
+    return answer(
+        [
+            boundary(
+                project["areaOfInterest"],
+                adminName2="TM",
+                countryName="Boundary",
+                adminName1="Project",
+            )
+        ]
+    )
+
+
+def lookups(query):
+    """(name, lookup, argument) of the lookups that apply to a normalized query."""
+    words = query.split(" ")
+    argument = words[1] if len(words) > 1 else ""
+    if query.startswith("hdx"):
+        if settings.RAW_DATA_API_URL and argument:
+            return [("hdx", hdx_countries, argument)]
+    elif query.startswith("osm"):
+        if settings.RAW_DATA_API_URL and argument.isdigit():
+            return [("osm", osm_element, argument)]
+    elif query.startswith("tm"):
+        if settings.TASKING_MANAGER_API_URL and argument.isdigit():
+            return [("tm", tm_project, argument)]
+    elif query:
+        return unprefixed_lookups(query)
+    return []
+
+
+def unprefixed_lookups(query):
+    """GeoNames, and every other configured lookup that can answer query."""
+    applicable = [("geonames", geonames, query)]
+    if not query.isdigit():
+        candidates = [("hdx", hdx_countries, settings.RAW_DATA_API_URL)]
+    else:
+        candidates = [
+            ("osm", osm_element, settings.RAW_DATA_API_URL),
+            ("tm", tm_project, settings.TASKING_MANAGER_API_URL),
+        ]
+    return applicable + [
+        (name, lookup, query) for name, lookup, configured in candidates if configured
+    ]
+
+
+def cache_get(client, key):
+    try:
+        cached = client.get(key)
+    except redis.RedisError as ex:
+        LOG.warning("Geocoding cache unavailable: {0}".format(ex))
+        return None
+    return json.loads(cached) if cached is not None else None
+
+
+def cache_set(client, key, future):
+    if future.exception() is not None:
+        return
+    try:
+        client.set(key, json.dumps(future.result()), ex=CACHE_TTL)
+    except redis.RedisError as ex:
+        LOG.warning("Geocoding cache unavailable: {0}".format(ex))
+
+
+def search(query, client=None):
+    """
+    The results of every lookup that applies to query, in lookup order,
+    with the sum of their totalResultsCount.
+    """
+    client = client or get_client()
+    applicable = lookups(normalize(query))
+    results = {}
+    pending = {}
+    for name, lookup, argument in applicable:
+        key = CACHE_KEY.format(name, hashlib.md5(argument.encode()).hexdigest())
+        cached = cache_get(client, key)
+        if cached is not None:
+            results[name] = cached
+        else:
+            future = executor.submit(lookup, argument)
+            future.add_done_callback(lambda f, key=key: cache_set(client, key, f))
+            pending[future] = name
+
+    done, not_done = wait(pending, timeout=DEADLINE)
+    for future in done:
+        try:
+            results[pending[future]] = future.result()
+        except Exception as ex:
+            LOG.warning("{0} lookup failed: {1}".format(pending[future], ex))
+    for future in not_done:
+        LOG.warning("{0} lookup timed out".format(pending[future]))
+    answers = [results[name] for name, _, _ in applicable if name in results]
+    return answer(
+        [result for a in answers for result in a["geonames"]],
+        sum(a["totalResultsCount"] for a in answers),
+    )
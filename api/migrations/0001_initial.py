@@ -0,0 +1,60 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="UserRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField(unique=True)),
+                ("users_count", models.IntegerField(default=0)),
+            ],
+            options={"db_table": "stats_users_daily"},
+        ),
+        migrations.CreateModel(
+            name="JobRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField(db_index=True)),
+                ("country", models.CharField(blank=True, default="", max_length=2)),
+                ("jobs_count", models.IntegerField(default=0)),
+                ("centroids", models.JSONField(default=list)),
+            ],
+            options={"db_table": "stats_jobs_daily", "unique_together": {("day", "country")}},
+        ),
+        migrations.CreateModel(
+            name="RunRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField(db_index=True)),
+                ("kind", models.CharField(max_length=10)),
+                ("status", models.CharField(blank=True, default="", max_length=20)),
+                ("runs_count", models.IntegerField(default=0)),
+                ("total_bytes", models.BigIntegerField(default=0)),
+            ],
+            options={"db_table": "stats_runs_daily", "unique_together": {("day", "kind", "status")}},
+        ),
+        migrations.CreateModel(
+            name="FormatRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField(db_index=True)),
+                ("export_format", models.CharField(max_length=10)),
+                ("runs_count", models.IntegerField(default=0)),
+            ],
+            options={"db_table": "stats_formats_daily", "unique_together": {("day", "export_format")}},
+        ),
+        migrations.CreateModel(
+            name="RollupRefresh",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("refreshed_at", models.DateTimeField()),
+            ],
+            options={"db_table": "stats_refresh"},
+        ),
+    ]
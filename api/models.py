@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Daily usage rollups read by the stats endpoints, kept up to date by the
+refresh_stats management command (see api/stats.py). Days are UTC.
+"""
+from django.db import models
+
+
+class UserRollup(models.Model):
+    day = models.DateField(unique=True)
+    users_count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "stats_users_daily"
+
+
+class JobRollup(models.Model):
+    day = models.DateField(db_index=True)
+    country = models.CharField(max_length=2, blank=True, default="")
+    jobs_count = models.IntegerField(default=0)
+    # [x, y] centroid of each job
+    centroids = models.JSONField(default=list)
+
+    class Meta:
+        db_table = "stats_jobs_daily"
+        unique_together = ("day", "country")
+
+
+class RunRollup(models.Model):
+    day = models.DateField(db_index=True)
+    kind = models.CharField(max_length=10)
+    status = models.CharField(max_length=20, blank=True, default="")
+    runs_count = models.IntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "stats_runs_daily"
+        unique_together = ("day", "kind", "status")
+
+
+class FormatRollup(models.Model):
+    day = models.DateField(db_index=True)
+    export_format = models.CharField(max_length=10)
+    runs_count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "stats_formats_daily"
+        unique_together = ("day", "export_format")
+
+
+class RollupRefresh(models.Model):
+    """When the rollups were last refreshed; days before it are complete."""
+
+    refreshed_at = models.DateTimeField()
+
+    class Meta:
+        db_table = "stats_refresh"
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""The snapshot of the machine_status endpoint, cached for SNAPSHOT_TTL seconds."""
+import json
+import threading
+from datetime import datetime, timedelta
+
+import dateutil.parser
+import psutil
+from cachetools.func import ttl_cache
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from jobs.models import HDXExportRegion
+from tasks import freshness
+from tasks.models import ExportRun
+
+SNAPSHOT_TTL = 10
+# seconds over which the collector averages CPU use
+SAMPLE_INTERVAL = 3
+
+SCHEDULE_COUNTS = (
+    ("Running_daily", "daily"),
+    ("Running_weekly", "weekly"),
+    ("Running_monthly", "monthly"),
+    ("Running_every_2_weeks", "2wks"),
+    ("Running_every_3_weeks", "3wks"),
+    ("Running_every_6hrs", "6hrs"),
+    ("Disabled", "disabled"),
+)
+
+
+class HostMetrics(object):
+    """
+    CPU and memory use of the host, sampled every SAMPLE_INTERVAL seconds
+    by a daemon thread started on first use in each process.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.cpu_percent = None
+        self.ram_percent = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            # threads don't survive a fork, so a worker starts its own
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="host-metrics", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.cpu_percent = psutil.cpu_percent(self.interval)
+            self.ram_percent = psutil.virtual_memory().percent
+
+    def sample(self):
+        """(CPU %, RAM %), CPU being None until the first interval elapsed."""
+        self.start()
+        if self.ram_percent is None:
+            return None, psutil.virtual_memory().percent
+        return self.cpu_percent, self.ram_percent
+
+
+host_metrics = HostMetrics()
+
+
+def run_counts(since):
+    """Runs created since `since` per status, and the start of the latest running one."""
+    counts = ExportRun.objects.filter(created_at__gte=since).aggregate(
+        submitted=Count("id", filter=Q(status="SUBMITTED")),
+        running=Count("id", filter=Q(status="RUNNING")),
+        failed=Count("id", filter=Q(status="FAILED")),
+        completed=Count("id", filter=Q(status="COMPLETED")),
+        last_running_at=Max("started_at", filter=Q(status="RUNNING")),
+    )
+    last_running_at = counts.pop("last_running_at")
+    counts["last_running_from"] = (
+        str(timezone.now() - last_running_at) if last_running_at else "N/A"
+    )
+    return counts
+
+
+def hdx_counts():
+    """HDX regions in total and per schedule period."""
+    return HDXExportRegion.objects.aggregate(
+        total_jobs=Count("id"),
+        **{
+            key: Count("id", filter=Q(schedule_period=period))
+            for key, period in SCHEDULE_COUNTS
+        }
+    )
+
+
+def behind_by(timestamp):
+    """How long ago timestamp was, or None for an upstream not polled yet."""
+    if not timestamp:
+        return None
+    return str(datetime.now(timezone.utc) - dateutil.parser.parse(timestamp))
+
+
+@ttl_cache(ttl=SNAPSHOT_TTL)
+def machine_snapshot():
+    cpu_percent, ram_percent = host_metrics.sample()
+    overpass = freshness.get("overpass_timestamp")
+    galaxy = freshness.get("rawdata_status")
+
+    overpass_timestamp = behind_by(overpass)
+    galaxy_timestamp = behind_by(galaxy and json.loads(galaxy)["lastUpdated"])
+    return {
+        "system": {
+            "current_time": datetime.now(),
+            "cpu_usage_%": int(cpu_percent) if cpu_percent is not None else None,
+            "ram_used_%": ram_percent,
+            "overpass_behind_by": overpass_timestamp,
+            "rawdata_api_behind_by": galaxy_timestamp,
+        },
+        "runs_since_a_day": run_counts(timezone.now() - timedelta(days=1)),
+        "hdx": hdx_counts(),
+    }
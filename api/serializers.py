@@ -11,6 +11,7 @@ import logging
 import django.core.exceptions
 from django.contrib.auth.models import User
 from django.db import transaction
+from django.utils import timezone
 from jobs.models import (
     HDXExportRegion,
     Job,
@@ -158,6 +159,7 @@ class PartnerExportRegionListSerializer(serializers.ModelSerializer):
             "name",
             "last_run",
             "next_run",
+            "last_skipped_at",
             "simplified_geom",
             "job_uid",
             "last_size",
@@ -187,6 +189,7 @@ class PartnerExportRegionSerializer(serializers.ModelSerializer):  # noqa
             "description",
             "last_run",
             "next_run",
+            "last_skipped_at",
             "simplified_geom",
             "job_uid",
             "the_geom",
@@ -286,6 +289,8 @@ class PartnerExportRegionSerializer(serializers.ModelSerializer):  # noqa
             ],
         )
         validate_model(instance)
+        # edits make the next scheduled run regenerate the region
+        job.updated_at = timezone.now()
         with transaction.atomic():
             instance.save()
             job.save()
@@ -316,6 +321,7 @@ class HDXExportRegionListSerializer(serializers.ModelSerializer):  # noqa
             "name",
             "last_run",
             "next_run",
+            "last_skipped_at",
             "simplified_geom",
             "dataset_prefix",
             "job_uid",
@@ -364,6 +370,7 @@ class HDXExportRegionSerializer(serializers.ModelSerializer):  # noqa
             "name",
             "last_run",
             "next_run",
+            "last_skipped_at",
             "simplified_geom",
             "dataset_prefix",
             "job_uid",
@@ -448,6 +455,8 @@ class HDXExportRegionSerializer(serializers.ModelSerializer):  # noqa
             ],
         )
         validate_model(instance)
+        # edits make the next scheduled run regenerate the region
+        job.updated_at = timezone.now()
         with transaction.atomic():
             instance.save()
             job.save()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Per-period usage stats behind the admin stats endpoints. Whole days up to
+the last refresh are read from the daily rollups of api/models.py, the rest
+of the window is aggregated from the raw rows in PostGIS. Days are UTC.
+"""
+import itertools
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta
+
+import dateutil.parser
+from django.contrib.auth.models import User
+from django.contrib.gis.db.models.functions import Centroid
+from django.contrib.postgres.aggregates import JSONBAgg
+from django.db import transaction
+from django.db.models import Count, FloatField, Func, JSONField, Min, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from api.models import FormatRollup, JobRollup, RollupRefresh, RunRollup, UserRollup
+from jobs.models import Job
+from tasks.models import ExportRun
+
+PERIODS = ("day", "week", "month")
+DAY = timedelta(days=1)
+# days always refreshed before the last refresh, for changes that leave no
+# timestamp behind, such as a cancelled run
+REFRESH_LOOKBACK = timedelta(days=2)
+
+
+def period_day(day, period):
+    """The first day of the day, week or month of day. Weeks start on Sunday."""
+    if period == "month":
+        return day.replace(day=1)
+    if period == "week":
+        return day - timedelta(days=(day.weekday() + 1) % 7)
+    return day
+
+
+def period_label(day, period):
+    return period_day(day, period).strftime(
+        "%Y-%m" if period == "month" else "%Y-%m-%d"
+    )
+
+
+def to_datetime(value):
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def days_between(first, last):
+    return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+
+def day_ranges(days):
+    """(first, last) of each run of consecutive days."""
+    days = sorted(set(days))
+    for _, group in itertools.groupby(
+        enumerate(days), lambda d: d[1] - timedelta(days=d[0])
+    ):
+        group = list(group)
+        yield group[0][1], group[-1][1]
+
+
+def user_days(after, before):
+    """(day, users who joined)."""
+    return (
+        User.objects.filter(date_joined__gte=after, date_joined__lte=before)
+        .annotate(day=TruncDate("date_joined"))
+        .values("day")
+        .annotate(count=Count("id"))
+        .values_list("day", "count")
+    )
+
+
+def job_days(after, before):
+    """(day, country, jobs created, [[x, y] centroid of each job])."""
+    centroid = Centroid("the_geom")
+    return (
+        Job.objects.filter(created_at__gte=after, created_at__lte=before)
+        .annotate(day=TruncDate("created_at"))
+        .values("day", "country")
+        .annotate(
+            count=Count("id"),
+            centroids=JSONBAgg(
+                Func(
+                    Func(centroid, function="ST_X", output_field=FloatField()),
+                    Func(centroid, function="ST_Y", output_field=FloatField()),
+                    function="jsonb_build_array",
+                    output_field=JSONField(),
+                )
+            ),
+        )
+        .values_list("day", "country", "count", "centroids")
+    )
+
+
+def run_days(after, before):
+    """
+    (day, job kind, status, export formats, runs started, their bytes).
+    Runs are counted per format list: Postgres can't group by unnest().
+    """
+    return (
+        ExportRun.objects.filter(started_at__gte=after, started_at__lte=before)
+        .annotate(day=TruncDate("started_at"))
+        .values("day", "job__kind", "status", "job__export_formats")
+        .annotate(count=Count("id"), total_bytes=Coalesce(Sum("total_bytes"), 0))
+        .values_list(
+            "day", "job__kind", "status", "job__export_formats", "count", "total_bytes"
+        )
+    )
+
+
+def split_window(after, before):
+    """
+    The whole days of the window the rollups hold, as (first, last) or None,
+    and the (after, before) parts of the window left to read raw rows for.
+    """
+    after, before = to_datetime(after), to_datetime(before)
+    refresh = RollupRefresh.objects.first()
+    if refresh is None:
+        return None, [(after, before)]
+    first = timezone.localdate(after)
+    if day_start(first) < after:
+        first += DAY
+    # the day of the refresh and later ones may have changed since
+    last = (
+        min(timezone.localdate(before), timezone.localdate(refresh.refreshed_at)) - DAY
+    )
+    if first > last:
+        return None, [(after, before)]
+    raw = []
+    if after < day_start(first):
+        # rows at day_start(first) belong to the rollups
+        raw.append((after, day_start(first) - timedelta(microseconds=1)))
+    raw.append((day_start(last + DAY), before))
+    return (first, last), raw
+
+
+def job_periods(after, before, period):
+    """
+    Periods of the window with jobs, latest first: their start_date,
+    jobs_count, users_count, Counter of countries and job centroids.
+    """
+    periods = defaultdict(
+        lambda: {
+            "jobs_count": 0,
+            "users_count": 0,
+            "countries": Counter(),
+            "centroids": [],
+        }
+    )
+    days, raw = split_window(after, before)
+    users = [user_days(*window) for window in raw]
+    jobs = [job_days(*window) for window in raw]
+    if days:
+        users.append(
+            UserRollup.objects.filter(day__range=days).values_list("day", "users_count")
+        )
+        jobs.append(
+            JobRollup.objects.filter(day__range=days).values_list(
+                "day", "country", "jobs_count", "centroids"
+            )
+        )
+
+    for day, count in itertools.chain(*users):
+        periods[period_label(day, period)]["users_count"] += count
+    for day, country, count, centroids in itertools.chain(*jobs):
+        stats = periods[period_label(day, period)]
+        stats["jobs_count"] += count
+        stats["centroids"].extend(centroids)
+        if country:
+            stats["countries"][country] += count
+    return [
+        dict(stats, start_date=label)
+        for label, stats in sorted(periods.items(), reverse=True)
+        if stats["jobs_count"]
+    ]
+
+
+def add_runs(stats, kind, status, count):
+    """Count runs of kind and status in the stats of a period."""
+    stats["runs_count"] += count
+    if kind == "hdx":
+        stats["run_types"]["hdx_run"] += count
+        stats["hdx_run_status"][status.lower()] += count
+    else:
+        stats["run_types"]["on_demand"] += count
+        stats["normal_run_status"][status.lower()] += count
+
+
+def run_buckets(after, before, period):
+    """The stats of the runs of the window, by period label."""
+    periods = defaultdict(
+        lambda: {
+            "runs_count": 0,
+            "run_types": Counter(),
+            "hdx_run_status": Counter(),
+            "normal_run_status": Counter(),
+            "export_formats": Counter(),
+        }
+    )
+    days, raw = split_window(after, before)
+    if days:
+        for day, kind, status, count in RunRollup.objects.filter(
+            day__range=days
+        ).values_list("day", "kind", "status", "runs_count"):
+            add_runs(periods[period_label(day, period)], kind, status, count)
+        for day, export_format, count in FormatRollup.objects.filter(
+            day__range=days
+        ).values_list("day", "export_format", "runs_count"):
+            periods[period_label(day, period)]["export_formats"][export_format] += count
+    for window in raw:
+        for day, kind, status, export_formats, count, _ in run_days(*window):
+            stats = periods[period_label(day, period)]
+            add_runs(stats, kind, status, count)
+            for f in export_formats:
+                stats["export_formats"][f] += count
+    return periods
+
+
+def run_periods(after, before, period):
+    """
+    Periods of the window with runs, latest first: their start_date,
+    runs_count, and Counters of run types, statuses of HDX and of other runs,
+    and export formats.
+    """
+    periods = run_buckets(after, before, period)
+
+    # most_common keeps insertion order among equal counts
+    for stats in periods.values():
+        for key in ("hdx_run_status", "normal_run_status"):
+            stats[key] = Counter(dict(sorted(stats[key].items())))
+    return [
+        dict(stats, start_date=label)
+        for label, stats in sorted(periods.items(), reverse=True)
+    ]
+
+
+def changed_days(since):
+    """
+    Days whose rollups may differ from the rows changed after `since`:
+    those of new or updated rows, and every day from REFRESH_LOOKBACK
+    before `since` to today.
+    """
+    days = set(User.objects.filter(date_joined__gte=since).dates("date_joined", "day"))
+    days.update(
+        Job.objects.filter(Q(created_at__gte=since) | Q(updated_at__gte=since)).dates(
+            "created_at", "day"
+        )
+    )
+    days.update(
+        ExportRun.objects.filter(started_at__isnull=False)
+        .filter(
+            Q(started_at__gte=since)
+            | Q(finished_at__gte=since)
+            | Q(status__in=["SUBMITTED", "RUNNING"])
+            # format lists of region jobs can be edited
+            | Q(job__updated_at__gte=since)
+        )
+        .dates("started_at", "day")
+    )
+    days.update(
+        days_between(timezone.localdate(since - REFRESH_LOOKBACK), timezone.localdate())
+    )
+    return days
+
+
+def all_days():
+    first = [
+        value
+        for value in (
+            User.objects.aggregate(first=Min("date_joined"))["first"],
+            Job.objects.aggregate(first=Min("created_at"))["first"],
+            ExportRun.objects.aggregate(first=Min("started_at"))["first"],
+        )
+        if value
+    ]
+    if not first:
+        return []
+    return days_between(timezone.localdate(min(first)), timezone.localdate())
+
+
+def refresh_rollups(days=()):
+    """
+    Recompute the rollups of days and of the days changed since the last
+    refresh, or of every day on the first one. Returns the days refreshed.
+    """
+    now = timezone.now()
+    previous = RollupRefresh.objects.first()
+    days = sorted(
+        set(days) | set(changed_days(previous.refreshed_at) if previous else all_days())
+    )
+
+    with transaction.atomic():
+        for first, last in day_ranges(days):
+            after, before = day_start(first), day_start(last + DAY) - timedelta(
+                microseconds=1
+            )
+            for model in (UserRollup, JobRollup, RunRollup, FormatRollup):
+                model.objects.filter(day__range=(first, last)).delete()
+
+            UserRollup.objects.bulk_create(
+                UserRollup(day=day, users_count=count)
+                for day, count in user_days(after, before)
+            )
+            JobRollup.objects.bulk_create(
+                JobRollup(
+                    day=day, country=country, jobs_count=count, centroids=centroids
+                )
+                for day, country, count, centroids in job_days(after, before)
+            )
+            runs = defaultdict(lambda: [0, 0])
+            formats = Counter()
+            for day, kind, status, export_formats, count, total_bytes in run_days(
+                after, before
+            ):
+                runs[(day, kind, status)][0] += count
+                runs[(day, kind, status)][1] += total_bytes
+                for f in export_formats:
+                    formats[(day, f)] += count
+            RunRollup.objects.bulk_create(
+                RunRollup(
+                    day=day,
+                    kind=kind,
+                    status=status,
+                    runs_count=count,
+                    total_bytes=nbytes,
+                )
+                for (day, kind, status), (count, nbytes) in runs.items()
+            )
+            FormatRollup.objects.bulk_create(
+                FormatRollup(day=day, export_format=f, runs_count=count)
+                for (day, f), count in formats.items()
+            )
+        RollupRefresh.objects.update_or_create(id=1, defaults={"refreshed_at": now})
+    return days
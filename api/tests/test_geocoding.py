@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from api import geocoding
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+@override_settings(
+    GEONAMES_API_URL="http://geonames/",
+    RAW_DATA_API_URL="http://rawdata/",
+    TASKING_MANAGER_API_URL="http://tm",
+)
+class TestGeocoding(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeRedis()
+
+    def test_lookups(self):
+        def names(query):
+            lookups = geocoding.lookups(geocoding.normalize(query))
+            return [(name, argument) for name, _, argument in lookups]
+
+        self.assertEqual(
+            names("  Monrovia   Liberia "),
+            [("geonames", "monrovia liberia"), ("hdx", "monrovia liberia")],
+        )
+        self.assertEqual(
+            names("1234"), [("geonames", "1234"), ("osm", "1234"), ("tm", "1234")]
+        )
+        self.assertEqual(names("hdx Liberia"), [("hdx", "liberia")])
+        self.assertEqual(names("osm 1234"), [("osm", "1234")])
+        self.assertEqual(names("osm abc"), [])
+        self.assertEqual(names("tm 42"), [("tm", "42")])
+        self.assertEqual(names(""), [])
+
+    @patch(
+        "api.geocoding.get_json",
+        return_value={"totalResultsCount": 57, "geonames": [{"name": "Monrovia"}]},
+    )
+    @override_settings(RAW_DATA_API_URL=None)
+    def test_search_is_cached(self, get_json):
+        expected = {"totalResultsCount": 57, "geonames": [{"name": "Monrovia"}]}
+        self.assertEqual(geocoding.search("Monrovia", self.client), expected)
+        self.assertEqual(geocoding.search("monrovia ", self.client), expected)
+        self.assertEqual(get_json.call_count, 1)
+
+    def test_fan_out_with_slow_backend(self):
+        release = threading.Event()
+        liberia = {
+            "geometry": {"type": "Point", "coordinates": [-9.4, 6.4]},
+            "properties": {"iso_3": "LBR", "name": "Liberia", "cid": 1},
+        }
+
+        def get_json(url, **params):
+            if url == "http://geonames/":
+                release.wait(5)
+                return {"totalResultsCount": 3, "geonames": [{"name": "Liberia"}]}
+            return {"features": [liberia]}
+
+        with patch("api.geocoding.DEADLINE", 0.5), patch(
+            "api.geocoding.get_json", side_effect=get_json
+        ):
+            response = geocoding.search("Liberia", self.client)
+            release.set()
+        # GeoNames timed out, the country boundary is answered alone
+        self.assertEqual(response["totalResultsCount"], 1)
+        self.assertEqual(response["geonames"][0]["countryName"], "Liberia")
+
+    def test_slow_lookup(self):
+        release = threading.Event()
+
+        def slow(argument):
+            release.wait(5)
+            return geocoding.answer([{"name": argument}])
+
+        with patch("api.geocoding.DEADLINE", 0.1), patch(
+            "api.geocoding.lookups", return_value=[("geonames", slow, "monrovia")]
+        ):
+            self.assertEqual(
+                geocoding.search("monrovia", self.client), geocoding.answer([])
+            )
+            release.set()
+            for _ in range(50):
+                if self.client.values:
+                    break
+                time.sleep(0.1)
+            # the late result is cached for the next search
+            self.assertEqual(
+                geocoding.search("monrovia", self.client),
+                geocoding.answer([{"name": "monrovia"}]),
+            )
@@ -2,6 +2,7 @@
 import json
 import os
 import uuid
+from datetime import datetime
 
 from mock import patch
 
@@ -17,6 +18,9 @@ from rest_framework.reverse import reverse
 from rest_framework.test import APITestCase
 import unittest
 
+from api.models import JobRollup, RunRollup
+from api.monitoring import machine_snapshot
+from api.stats import refresh_rollups, split_window
 from jobs.models import Job, HDXExportRegion
 from tasks.models import ExportRun, ExportTask
 from feature_selection.feature_selection import FeatureSelection
@@ -253,6 +257,8 @@ class TestHDXExportRegionViewSet(APITestCase):
         j = Job.objects.get(uid=response.data['job_uid'])
         self.assertTrue(j.hidden)
         self.assertTrue(j.unlimited_extent)
+        self.assertEqual(j.kind, "hdx")
+        self.assertTrue(j.is_hdx)
 
     def test_create_region_permission(self):
         self.user = User.objects.create_user(
@@ -314,6 +320,130 @@ class TestHDXExportRegionViewSet(APITestCase):
         self.assertTrue("dataset_prefix" in response.data)
 
 
-
-
-
+class TestStats(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            username='admin', email='admin@demo.com', password='demo'
+        )
+        self.client.force_login(self.user)
+        the_geom = GEOSGeometry(Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)), srid=4326)
+        # a Saturday, then the Sunday and Tuesday of the following week
+        for day in ('2021-01-02', '2021-01-03', '2021-01-05'):
+            Job.objects.create(
+                user=self.user, name='TestJob', the_geom=the_geom, export_formats=['shp'],
+                feature_selection=FeatureSelection.example('simple'),
+                created_at=datetime.fromisoformat(day + 'T12:00:00+00:00'),
+            )
+
+    def test_stats_by_week(self):
+        response = self.client.get(
+            '/api/stats', {'after': '2021-01-01', 'before': '2021-01-10', 'period': 'week'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual(
+            [(p['start_date'], p['jobs_count']) for p in data['periods']],
+            [('2021-01-03', 2), ('2020-12-27', 1)],
+        )
+        self.assertEqual(len(data['geoms']), 3)
+        self.assertAlmostEqual(data['geoms'][0][0], -10.79919, places=4)
+
+    def test_stats_top_regions(self):
+        Job.objects.update(country='LR')
+        Job.objects.filter(created_at__day=5).update(country='GN')
+        response = self.client.get(
+            '/api/stats', {'after': '2021-01-01', 'before': '2021-01-10', 'period': 'month'}
+        )
+        data = json.loads(response.content)
+        self.assertEqual(data['periods'][0]['start_date'], '2021-01')
+        self.assertEqual(data['periods'][0]['top_regions'], 'LR:2 GN:1')
+
+    def test_run_stats(self):
+        jobs = list(Job.objects.order_by('created_at'))
+        jobs[0].kind = 'hdx'
+        jobs[0].export_formats = ['shp', 'geopackage']
+        jobs[0].save()
+        started_at = datetime.fromisoformat('2021-01-05T12:00:00+00:00')
+        for job, run_status in zip(jobs, ['COMPLETED', 'FAILED', 'COMPLETED']):
+            ExportRun.objects.create(
+                job=job, user=self.user, status=run_status, started_at=started_at
+            )
+        response = self.client.get(
+            '/api/run_stats', {'after': '2021-01-01', 'before': '2021-01-10', 'period': 'day'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['periods'], [{
+            'start_date': '2021-01-05',
+            'runs_count': 3,
+            'run_types': 'on_demand:2,hdx_run:1',
+            'hdx_run_status': 'completed:1',
+            'normal_run_status': 'completed:1,failed:1',
+            'export_formats': 'shp:3,geopackage:1',
+        }])
+
+    def test_stats_from_rollups(self):
+        Job.objects.update(country='LR')
+        ExportRun.objects.create(
+            job=Job.objects.first(), user=self.user, status='COMPLETED',
+            started_at=datetime.fromisoformat('2021-01-05T12:00:00+00:00'),
+        )
+        params = {'after': '2021-01-02T06:00:00Z', 'before': '2021-01-10', 'period': 'week'}
+        raw = [self.client.get(url, params).content for url in ('/api/stats', '/api/run_stats')]
+        refresh_rollups()
+        rollups = JobRollup.objects.filter(day__range=('2021-01-02', '2021-01-05'))
+        self.assertEqual(rollups.count(), 3)
+        self.assertEqual(RunRollup.objects.get(day='2021-01-05').runs_count, 1)
+        # the first half day is read from the jobs table, the rest from the rollups
+        first = split_window(params['after'], params['before'])[0][0]
+        self.assertEqual(first.isoformat(), '2021-01-03')
+        for url, content in zip(('/api/stats', '/api/run_stats'), raw):
+            response = self.client.get(url, params)
+            self.assertEqual(json.loads(response.content), json.loads(content))
+
+    def test_stats_invalid_period(self):
+        response = self.client.get('/api/stats', {'period': 'year'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestMachineStatus(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            username='admin', email='admin@demo.com', password='demo'
+        )
+        self.client.force_login(self.user)
+        job = Job.objects.create(
+            user=self.user, name='TestJob', export_formats=['shp'],
+            the_geom=GEOSGeometry(Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)), srid=4326),
+            feature_selection=FeatureSelection.example('simple'),
+        )
+        for run_status in ('RUNNING', 'FAILED', 'COMPLETED', 'COMPLETED'):
+            ExportRun.objects.create(job=job, user=self.user, status=run_status)
+        machine_snapshot.cache_clear()
+
+    @patch('api.monitoring.host_metrics.sample', return_value=(12.5, 40.0))
+    @patch('api.monitoring.freshness.get')
+    def test_machine_status(self, get, sample):
+        get.side_effect = lambda name: {
+            'overpass_timestamp': '2021-01-01T00:00:00Z',
+            'rawdata_status': '{"lastUpdated": "2021-01-01T00:00:00Z"}',
+        }[name]
+        with self.assertNumQueries(2):
+            machine_snapshot()
+        response = self.client.get('/api/status')
+        data = json.loads(response.content)
+        self.assertEqual(data['system']['cpu_usage_%'], 12)
+        self.assertEqual(data['runs_since_a_day']['completed'], 2)
+        self.assertEqual(data['runs_since_a_day']['running'], 1)
+        self.assertEqual(data['hdx']['total_jobs'], 0)
+        # the second call is served from the cached snapshot
+        self.assertEqual(get.call_count, 2)
+
+    @patch('api.monitoring.host_metrics.sample', return_value=(12.5, 40.0))
+    @patch('tasks.freshness.get', return_value=None)
+    def test_upstreams_not_polled(self, get, sample):
+        data = json.loads(self.client.get('/api/status').content)
+        self.assertIsNone(data['system']['overpass_behind_by'])
+        self.assertIsNone(data['system']['rawdata_api_behind_by'])
+        response = self.client.get('/api/overpass_timestamp')
+        self.assertEqual(json.loads(response.content), {'timestamp': None})
+        self.assertEqual(self.client.get('/api/overpass_status').status_code, 503)
@@ -2,20 +2,15 @@
 
 # -*- coding: utf-8 -*-
 from distutils.util import strtobool
-import itertools
 from itertools import chain
 import logging
 import json
 from django.utils import timezone
-from datetime import datetime, timedelta
-from collections import Counter
-import os
+from datetime import timedelta
 import io
 import csv
 import dateutil.parser
 import requests
-from cachetools.func import ttl_cache
-from django.contrib.auth.models import User
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import Permission
@@ -27,6 +22,7 @@ from django.http import (
     HttpResponse,
     HttpResponseNotFound,
     HttpResponseForbidden,
+    HttpResponseBadRequest,
 )
 from django.views.decorators.http import require_http_methods
 from django.core.exceptions import ValidationError as DjangoValidationError
@@ -47,6 +43,10 @@ from api.serializers import (
     PartnerExportRegionSerializer,
     JobSerializer,
 )
+from api import geocoding
+from api.monitoring import machine_snapshot
+from api.stats import PERIODS, job_periods, run_periods
+from tasks import freshness
 from tasks.models import ExportRun, ExportTask
 from tasks.task_runners import ExportTaskRunner
 
@@ -54,8 +54,6 @@ from .permissions import IsHDXAdmin, IsOwnerOrReadOnly, IsMemberOfGroup
 from .renderers import HOTExportApiRenderer
 
 from hdx_exports.hdx_export_set import sync_region
-from rtree import index
-import psutil
 
 # Get an instance of a logger
 LOG = logging.getLogger(__name__)
@@ -63,13 +61,6 @@ LOG = logging.getLogger(__name__)
 # controls how api responses are rendered
 renderer_classes = (JSONRenderer, HOTExportApiRenderer)
 
-DIR = os.path.dirname(os.path.abspath(__file__))
-try:
-    idx = index.Rtree(os.path.join(DIR, "reverse_geocode"))
-except Exception as ex:
-    # pass
-    raise ex
-
 
 def bbox_to_geom(s):
     try:
@@ -129,7 +120,8 @@ class JobViewSet(viewsets.ModelViewSet):
 
         if bbox is not None:
             bbox = bbox_to_geom(bbox)
-            queryset = queryset.filter(Q(the_geom__within=bbox))
+            # a geometry is within a rectangle exactly when its envelope is
+            queryset = queryset.filter(Q(envelope__within=bbox))
 
         if pinned:
             queryset = queryset.filter(Q(pinned=True))
@@ -278,7 +270,7 @@ class HDXExportRegionViewSet(viewsets.ModelViewSet):
         if schedule_period not in [None, "any"]:
             queryset = queryset.filter(Q(schedule_period=schedule_period))
 
-        return queryset.prefetch_related("job__runs__tasks").defer("job__the_geom")
+        return queryset.select_related("job", "job__last_run").defer("job__the_geom")
 
     def get_serializer_class(self):
         if self.action == "list":
@@ -316,7 +308,7 @@ class PartnerExportRegionViewSet(viewsets.ModelViewSet):
         group_ids = self.request.user.groups.values_list("id")
         return (
             PartnerExportRegion.objects.filter(deleted=False, group_id__in=group_ids)
-            .prefetch_related("job__runs__tasks")
+            .select_related("job", "job__last_run")
             .defer("job__the_geom")
         )
 
@@ -350,63 +342,21 @@ def stats(request):
     after = request.GET.get("after", timezone.now() - timedelta(days=1))
     period = request.GET.get("period", "day")
     is_csv = request.GET.get("csv", False) == "true"
-
-    def toWeek(dt):
-        sunday = dt.strftime("%Y-%U-0")
-        return datetime.strptime(sunday, "%Y-%U-%w").strftime("%Y-%m-%d")
-
-    def toDay(dt):
-        return dt.strftime("%Y-%m-%d")
-
-    def toMonth(dt):
-        return dt.strftime("%Y-%m")
-
-    if period == "day":
-        period_fn = toDay
-    elif period == "week":
-        period_fn = toWeek
-    elif period == "month":
-        period_fn = toMonth
-
-    users = (
-        User.objects.only("date_joined")
-        .filter(date_joined__gte=after, date_joined__lte=before)
-        .order_by("-date_joined")
-    )
-
-    grouped_users_by_period = {}
-    for gu in itertools.groupby(users, lambda u: period_fn(u.date_joined)):
-        grouped_users_by_period[gu[0]] = len(list(gu[1]))
-
-    queryset = Job.objects.only("created_at", "the_geom").order_by("-created_at")
-    if before:
-        queryset = queryset.filter(Q(created_at__lte=before))
-    if after:
-        queryset = queryset.filter(Q(created_at__gte=after))
-
-    grouped_jobs = itertools.groupby(queryset, lambda j: period_fn(j.created_at))
+    if period not in PERIODS:
+        return HttpResponseBadRequest("period must be one of {0}".format(", ".join(PERIODS)))
 
     geoms = []
     periods = []
-    for x in grouped_jobs:
-        top_regions = Counter()
-        jobs_in_group = list(x[1])
-        for j in jobs_in_group:
-            centroid = j.the_geom.centroid
-            geoms.append([centroid.x, centroid.y])
-            result = next(idx.nearest((centroid.x, centroid.y), 1, objects=True))
-            top_regions[result.object[2]] += 1
-
-        users_in_period = grouped_users_by_period.get(x[0], 0)
-
+    for jobs in job_periods(after, before, period):
+        geoms.extend(jobs["centroids"])
         top_regions_string = " ".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in top_regions.most_common(5)]
+            ["{0}:{1}".format(x[0], x[1]) for x in jobs["countries"].most_common(5)]
         )
         periods.append(
             {
-                "start_date": x[0],
-                "jobs_count": len(jobs_in_group),
-                "users_count": users_in_period,
+                "start_date": jobs["start_date"],
+                "jobs_count": jobs["jobs_count"],
+                "users_count": jobs["users_count"],
                 "top_regions": top_regions_string,
             }
         )
@@ -437,73 +387,28 @@ def run_stats(request):
     after = request.GET.get("after", timezone.now() - timedelta(days=1))
     period = request.GET.get("period", "day")
     is_csv = request.GET.get("csv", False) == "true"
-
-    def toWeek(dt):
-        sunday = dt.strftime("%Y-%U-0")
-        return datetime.strptime(sunday, "%Y-%U-%w").strftime("%Y-%m-%d")
-
-    def toDay(dt):
-        return dt.strftime("%Y-%m-%d")
-
-    def toMonth(dt):
-        return dt.strftime("%Y-%m")
-
-    if period == "day":
-        period_fn = toDay
-    elif period == "week":
-        period_fn = toWeek
-    elif period == "month":
-        period_fn = toMonth
-
-    run_queryset = ExportRun.objects.only("started_at", "status").order_by(
-        "-started_at"
-    )
-
-    if before:
-        run_queryset = run_queryset.filter(Q(started_at__lte=before))
-    if after:
-        run_queryset = run_queryset.filter(Q(started_at__gte=after))
-
-    grouped_runs = itertools.groupby(run_queryset, lambda j: period_fn(j.started_at))
+    if period not in PERIODS:
+        return HttpResponseBadRequest("period must be one of {0}".format(", ".join(PERIODS)))
 
     periods = []
-    for x in grouped_runs:
-        run_types = Counter()
-        export_formats = Counter()
-        hdx_run_status = Counter()
-        normal_run_status = Counter()
-        runs_in_group = list(x[1])
-        for j in runs_in_group:
-            result = j.is_hdx
-            if result is True:
-                result = "hdx_run"
-                hdx_status = j.status
-                hdx_run_status[hdx_status.lower()] += 1
-            else:
-                result = "on_demand"
-                normal_status = j.status
-                normal_run_status[normal_status.lower()] += 1
-            run_types[result] += 1
-            export_format = j.export_formats
-            for f in export_format:
-                export_formats[str(f)] += 1
+    for runs in run_periods(after, before, period):
         run_types_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in run_types.most_common(5)]
+            ["{0}:{1}".format(x[0], x[1]) for x in runs["run_types"].most_common(5)]
         )
         export_formats_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in export_formats.most_common(10)]
+            ["{0}:{1}".format(x[0], x[1]) for x in runs["export_formats"].most_common(10)]
         )
         hdx_run_status_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in hdx_run_status.most_common(4)]
+            ["{0}:{1}".format(x[0], x[1]) for x in runs["hdx_run_status"].most_common(4)]
         )
         normal_run_status_string = ",".join(
-            ["{0}:{1}".format(x[0], x[1]) for x in normal_run_status.most_common(4)]
+            ["{0}:{1}".format(x[0], x[1]) for x in runs["normal_run_status"].most_common(4)]
         )
 
         periods.append(
             {
-                "start_date": x[0],
-                "runs_count": len(runs_in_group),
+                "start_date": runs["start_date"],
+                "runs_count": runs["runs_count"],
                 "run_types": run_types_string,
                 "hdx_run_status": hdx_run_status_string,
                 "normal_run_status": normal_run_status_string,
@@ -603,154 +508,43 @@ def request_nominatim(request):
 @require_http_methods(["GET"])
 @login_required()
 def request_geonames(request):
-    """Geocode with GeoNames."""
-    payload = {
-        "maxRows": 20,
-        "username": "osm_export_tool",
-        "style": "full",
-        "q": request.GET.get("q"),
-    }
-
-    geonames_url = getattr(settings, "GEONAMES_API_URL")
-    tm_url = getattr(settings, "TASKING_MANAGER_API_URL")
-    RAW_DATA_API_URL = getattr(settings, "RAW_DATA_API_URL")
-
-    if geonames_url:
-        keyword = request.GET.get("q")
-        response = {"totalResultsCount": 0, "geonames": []}
-        if not (
-            str(keyword).lower().startswith("hdx")
-            or str(keyword).lower().startswith("osm")
-            or str(keyword).lower().startswith("tm")
-        ):
-            response = requests.get(geonames_url, params=payload).json()
-        assert isinstance(response, dict)
-        if RAW_DATA_API_URL:
-            if str(keyword).lower().startswith("hdx"):
-                lst = keyword.split(" ")
-                if len(lst) > 1:
-                    keyword = lst[1]
-                    res = requests.get(f"{RAW_DATA_API_URL}v1/countries/?q={keyword}")
-                    if res.ok:
-                        if len(res.json()["features"]) >= 1:
-                            for feature in res.json()["features"]:
-                                geojson = {
-                                    "type": "FeatureCollection",
-                                    "features": [
-                                        {
-                                            "type": "Feature",
-                                            "properties": {},
-                                            "geometry": feature["geometry"],
-                                        }
-                                    ],
-                                }
-                                add_resp = {
-                                    "bbox": geojson,
-                                    "adminName2": f'ISO3 : {feature["properties"]["iso_3"]}',
-                                    "name": request.GET.get("q"),
-                                    "countryName": feature["properties"]["name"],
-                                    "adminName1": feature["properties"]["cid"],
-                                }
-
-                                if "geonames" in response:
-                                    response["geonames"].append(add_resp)
-                                response["totalResultsCount"] += 1
-
-            if str(keyword).lower().startswith("osm"):
-                lst = keyword.split(" ")
-                if len(lst) >= 1:
-                    keyword = lst[1]
-                    try:
-                        osm_id = int(keyword)
-                        res = requests.get(
-                            f"{RAW_DATA_API_URL}v1/osm_id/?osm_id={osm_id}"
-                        )
-                        if res.ok:
-                            if len(res.json()["features"]) >= 1:
-                                for feature in res.json()["features"]:
-                                    geojson = {
-                                        "type": "FeatureCollection",
-                                        "features": [
-                                            {
-                                                "type": "Feature",
-                                                "properties": {},
-                                                "geometry": feature["geometry"],
-                                            }
-                                        ],
-                                    }
-                                    add_resp = {
-                                        "bbox": geojson,
-                                        "adminName2": "OSM",
-                                        "name": request.GET.get("q"),
-                                        "countryName": osm_id,
-                                        "adminName1": "Element",
-                                    }
-
-                                    if "geonames" in response:
-                                        response["geonames"].append(add_resp)
-                    except:
-                        pass
-
-        if str(keyword).lower().startswith("tm"):
-            lst = keyword.split(" ")
-            if len(lst) >= 1:
-                keyword = lst[1]
-                if tm_url:
-                    try:
-                        tm_res = requests.get(f"{tm_url}/{int(keyword)}/")
-                    except Exception as ex:
-                        pass
-                    if tm_res.ok:
-                        tm_res = tm_res.json()
-                        if "areaOfInterest" in tm_res:
-                            print("TM Project found")
-                            geom = tm_res["areaOfInterest"]
-                            geojson = {
-                                "type": "FeatureCollection",
-                                "features": [
-                                    {
-                                        "type": "Feature",
-                                        "properties": {},
-                                        "geometry": geom,
-                                    }
-                                ],
-                            }
-
-                            add_resp = {
-                                "bbox": geojson,
-                                "adminName2": "TM",
-                                "name": request.GET.get("q"),
-                                "countryName": "Boundary",
-                                "adminName1": "Project",
-                            }
-                            # print(add_resp)
-                            if "geonames" in response:
-                                response["geonames"].append(add_resp)
-
-        return JsonResponse(response)
-    else:
+    """Geocode with GeoNames, or the Raw Data API and Tasking Manager for prefixed queries."""
+    if not getattr(settings, "GEONAMES_API_URL"):
         return JsonResponse(
             {"error": "A url was not provided for geonames"},
             status=500,
         )
 
+    query = request.GET.get("q")
+    response = geocoding.search(query)
+    # boundaries are named after the query, GeoNames places keep their name
+    response["geonames"] = [
+        dict({"name": query}, **result) for result in response["geonames"]
+    ]
+    return JsonResponse(response)
+
 
-@ttl_cache(ttl=60)
 @require_http_methods(["GET"])
 @login_required()
 def get_overpass_timestamp(request):
     """
-    Endpoint to show the last OSM update timestamp on the Create page.
-    this sometimes fails, returning a HTTP 200 but empty content.
+    Endpoint to show the last OSM update timestamp on the Create page,
+    as last polled by the poll_upstreams command: null until it has been.
     """
-    r = requests.get("{}timestamp".format(settings.OVERPASS_API_URL))
-    return JsonResponse({"timestamp": dateutil.parser.parse(r.content)})
+    timestamp = freshness.get("overpass_timestamp")
+    try:
+        timestamp = timestamp and dateutil.parser.parse(timestamp)
+    except (ValueError, OverflowError):
+        timestamp = None
+    return JsonResponse({"timestamp": timestamp or None})
 
 
 @login_required()
 def get_overpass_status(request):
-    r = requests.get("{}status".format(settings.OVERPASS_API_URL))
-    return HttpResponse(r.content)
+    status = freshness.get("overpass_status")
+    if status is None:
+        return HttpResponse("Overpass status not polled yet", status=503)
+    return HttpResponse(status)
 
 
 @require_http_methods(["GET"])
@@ -829,55 +623,4 @@ def cancel_run(request):
 def machine_status(request):
     if not request.user.is_superuser:
         return HttpResponseForbidden()
-    CPU_use = psutil.cpu_percent(3)
-    date_from = datetime.now() - timedelta(days=1)
-    hdx_jobs = HDXExportRegion.objects.all()
-    Runs_since_day = ExportRun.objects.filter(created_at__gte=date_from)
-    running_runs = Runs_since_day.filter(status="RUNNING").order_by("-started_at")
-    if running_runs:
-        last_run_timestamp = running_runs[0].started_at
-        last_run_running_from = str(timezone.now() - last_run_timestamp)
-    else:
-        last_run_timestamp = "N/A"
-        last_run_running_from = "N/A"
-    overpass = requests.get("{}timestamp".format(settings.OVERPASS_API_URL))
-    galaxy = requests.get("{}v1/status/".format(settings.RAW_DATA_API_URL))
-
-    overpass_timestamp = str(
-        datetime.now(timezone.utc) - dateutil.parser.parse(overpass.content)
-    )
-    galaxy_timestamp = str(
-        datetime.now(timezone.utc) - dateutil.parser.parse(galaxy.json()["lastUpdated"])
-    )
-    return JsonResponse(
-        {
-            "system": {
-                "current_time": datetime.now(),
-                "cpu_usage_%": int(CPU_use),
-                "ram_used_%": (psutil.virtual_memory()[2]),
-                "overpass_behind_by": overpass_timestamp,
-                "rawdata_api_behind_by": galaxy_timestamp,
-            },
-            "runs_since_a_day": {
-                "submitted": Runs_since_day.filter(status="SUBMITTED").count(),
-                "running": Runs_since_day.filter(status="RUNNING").count(),
-                "last_running_from": last_run_running_from,
-                "failed": Runs_since_day.filter(status="FAILED").count(),
-                "completed": Runs_since_day.filter(status="COMPLETED").count(),
-            },
-            "hdx": {
-                "total_jobs": hdx_jobs.count(),
-                "Running_daily": hdx_jobs.filter(schedule_period="daily").count(),
-                "Running_weekly": hdx_jobs.filter(schedule_period="weekly").count(),
-                "Running_monthly": hdx_jobs.filter(schedule_period="monthly").count(),
-                "Running_every_2_weeks": hdx_jobs.filter(
-                    schedule_period="2wks"
-                ).count(),
-                "Running_every_3_weeks": hdx_jobs.filter(
-                    schedule_period="3wks"
-                ).count(),
-                "Running_every_6hrs": hdx_jobs.filter(schedule_period="6hrs").count(),
-                "Disabled": hdx_jobs.filter(schedule_period="disabled").count(),
-            },
-        }
-    )
+    return JsonResponse(machine_snapshot())
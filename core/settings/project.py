@@ -22,6 +22,7 @@ INSTALLED_APPS += (
     "utils",
 )
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 dramatiq.set_broker(RedisBroker(host="localhost", port=6379))
 
 DATABASES = {}
@@ -60,6 +61,10 @@ EXPORT_STAGING_ROOT = os.getenv("EXPORT_STAGING_ROOT", ABS_PATH("../export_stagi
 EXPORT_DOWNLOAD_ROOT = os.getenv(
     "EXPORT_DOWNLOAD_ROOT", ABS_PATH("../export_downloads/")
 )
+# cleanup evicts downloads while less than this percentage of their disk is free
+DOWNLOAD_FREE_WATERMARK = float(os.getenv("DOWNLOAD_FREE_WATERMARK", 20))
+# nginx access log of /downloads/, counted into per-run download hits
+DOWNLOAD_ACCESS_LOG = os.getenv("DOWNLOAD_ACCESS_LOG", "")
 
 # the root url for export downloads
 EXPORT_MEDIA_ROOT = "/downloads/"
@@ -84,6 +89,25 @@ RAW_DATA_ACCESS_TOKEN = os.getenv("RAW_DATA_ACCESS_TOKEN")
 GENERATE_MWM = os.getenv("GENERATE_MWM", "/usr/local/bin/generate_mwm.sh")
 GENERATOR_TOOL = os.getenv("GENERATOR_TOOL", "/usr/local/bin/generator_tool")
 PLANET_FILE = os.getenv("PLANET_FILE", "")
+# bounds index of the regional shards kept next to the planet by jobs/secondary_pipeline.py
+PLANET_SHARDS_INDEX = os.getenv(
+    "PLANET_SHARDS_INDEX",
+    os.path.join(os.path.dirname(PLANET_FILE), "shards", "index.json")
+    if PLANET_FILE
+    else "",
+)
+# where each planet update changed OSM data, kept by jobs/secondary_pipeline.py;
+# scheduled regions without changes since their last run are skipped
+PLANET_CHANGES_INDEX = os.getenv(
+    "PLANET_CHANGES_INDEX",
+    os.path.join(os.path.dirname(PLANET_FILE), "changes", "index.json")
+    if PLANET_FILE
+    else "",
+)
+# concurrency of the dramatiq worker on the "scheduled" queue (--processes x --threads)
+SCHEDULED_WORKERS = int(os.getenv("SCHEDULED_WORKERS", 1))
+# the schedule command spreads due region runs over at most this many seconds
+SCHEDULE_SPREAD_WINDOW = int(os.getenv("SCHEDULE_SPREAD_WINDOW", 6 * 60 * 60))
 WORKER_SECRET_KEY = os.getenv("WORKER_SECRET_KEY", "nPsOG0vNSEpKdZMjHeQVX910aSoq6Jyp")
 
 """
@@ -0,0 +1,39 @@
+from django.contrib.gis.db.models.functions import Centroid
+from django.core.management.base import BaseCommand
+from jobs.models import Job
+from utils.reverse_geocode import nearest_place
+
+
+class Command(BaseCommand):
+    help = 'Store the country of existing jobs in Job.country, from the reverse geocoding index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Jobs per query')
+        parser.add_argument(
+            '--all', action='store_true', help='Also recompute jobs that have a country'
+        )
+
+    def handle(self, *args, **kwargs):
+        queryset = Job.objects.order_by('id')
+        if not kwargs['all']:
+            queryset = queryset.filter(country='')
+        batch_size = kwargs['batch_size']
+        last_id = 0
+        updated = 0
+        while True:
+            batch = list(
+                queryset.filter(id__gt=last_id)
+                .annotate(centroid=Centroid('the_geom'))
+                .values_list('id', 'centroid')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            jobs = []
+            for job_id, centroid in batch:
+                place = nearest_place(centroid.x, centroid.y)
+                if place:
+                    jobs.append(Job(id=job_id, country=place[2]))
+            Job.objects.bulk_update(jobs, ['country'])
+            updated += len(jobs)
+        self.stdout.write('Updated {0} jobs'.format(updated))
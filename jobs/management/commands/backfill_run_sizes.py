@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import BigIntegerField, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from tasks.models import ExportRun, ExportTask
+
+
+class Command(BaseCommand):
+    help = 'Store the summed file size of the tasks of existing runs in ExportRun.total_bytes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=10000, help='Runs per UPDATE statement'
+        )
+
+    def handle(self, *args, **kwargs):
+        task_bytes = (
+            ExportTask.objects.filter(run_id=OuterRef('id'))
+            .values('run_id')
+            .annotate(total=Sum('filesize_bytes'))
+            .values('total')
+        )
+        batch_size = kwargs['batch_size']
+        last_id = ExportRun.objects.aggregate(last=Max('id'))['last'] or 0
+        updated = 0
+        for start in range(0, last_id + 1, batch_size):
+            updated += ExportRun.objects.filter(id__gte=start, id__lt=start + batch_size).update(
+                total_bytes=Coalesce(Subquery(task_bytes), 0, output_field=BigIntegerField())
+            )
+        self.stdout.write('Updated {0} runs'.format(updated))
@@ -1,39 +1,248 @@
 import os
 import shutil
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from django.core.management.base import BaseCommand
-from tasks.models import ExportRun, HDXExportRegion, PartnerExportRegion
+from django.db.models import Max
 from django.conf import settings
 from django.utils import timezone
-from django.core.exceptions import ValidationError
-from datetime import timedelta
+from hurry.filesize import size
+from tasks import downloads
+from tasks.models import ExportRun
+
+MAX_AGE = timedelta(days=30)
+# leftovers of batch extracts whose runs never picked them up
+BATCH_MAX_AGE = timedelta(days=2)
+WORKERS = 8
+# uids per IN (...) query
+CHUNK_SIZE = 5000
+# runs younger than this are never evicted for disk space
+EVICTION_MIN_AGE = timedelta(days=2)
+# superseded region runs are evicted this much sooner
+SUPERSEDED_WEIGHT = 4
+GB = 1024 ** 3
+
+
+def is_uuid(name):
+    try:
+        uuid.UUID(name)
+        return True
+    except ValueError:
+        return False
+
+
+def chunks(items, n=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def download_runs(names):
+    """
+    The runs of the download directories in names, by uid: their job id,
+    creation time and status, whether the job belongs to a region, and
+    whether a newer completed run of that region exists.
+    """
+    runs = {}
+    for chunk in chunks(n for n in names if is_uuid(n)):
+        for uid, job_id, created_at, status, kind in ExportRun.objects.filter(
+            uid__in=chunk
+        ).values_list('uid', 'job_id', 'created_at', 'status', 'job__kind'):
+            runs[str(uid)] = {
+                'job_id': job_id,
+                'created_at': created_at,
+                'status': status,
+                'kind': kind,
+            }
+
+    region_jobs = {run['job_id'] for run in runs.values() if run['kind'] != 'plain'}
+    latest_completed = {}
+    for chunk in chunks(region_jobs):
+        latest_completed.update(
+            ExportRun.objects.filter(job_id__in=chunk, status='COMPLETED')
+            .values('job_id')
+            .annotate(latest=Max('created_at'))
+            .values_list('job_id', 'latest')
+        )
+    for run in runs.values():
+        latest = latest_completed.get(run['job_id'])
+        run['region'] = run['job_id'] in region_jobs
+        run['superseded'] = (
+            run['region'] and latest is not None and latest > run['created_at']
+        )
+    return runs
+
+
+def expired_downloads(names, runs, now):
+    """
+    (category, path) of every download directory to remove: directories of
+    unknown runs, and runs older than MAX_AGE, except the latest completed
+    run of a region.
+    """
+    for name in names:
+        path = os.path.join(settings.EXPORT_DOWNLOAD_ROOT, name)
+        run = runs.get(name)
+        if run is None:
+            yield 'orphaned', path
+        elif now - run['created_at'] > MAX_AGE:
+            if not run['region']:
+                yield 'expired', path
+            elif run['superseded']:
+                yield 'superseded region', path
+
+
+def eviction_score(run, nbytes, last_hit, now):
+    """
+    Higher is evicted first: downloads idle for long, large ones and those
+    of superseded region runs. Idle time counts from the last download, or
+    from the run's creation when it was never downloaded.
+    """
+    idle = now.timestamp() - max(last_hit or 0, run['created_at'].timestamp())
+    score = (idle / 86400 + 1) * (1 + nbytes / GB)
+    if run['superseded']:
+        score *= SUPERSEDED_WEIGHT
+    return score
+
+
+def evictions(names, runs, now, needed, hits):
+    """
+    (category, path) of download directories to remove, best scored first,
+    until `needed` bytes are reclaimed. Running runs, runs younger than
+    EVICTION_MIN_AGE and the latest completed run of a region are kept.
+    """
+    candidates = []
+    for name in names:
+        run = runs.get(name)
+        if (
+            run is None
+            or run['status'] in ('RUNNING', 'SUBMITTED')
+            or now - run['created_at'] < EVICTION_MIN_AGE
+            or (run['region'] and not run['superseded'])
+        ):
+            continue
+        path = os.path.join(settings.EXPORT_DOWNLOAD_ROOT, name)
+        nbytes = dir_size(path)
+        candidates.append(
+            (eviction_score(run, nbytes, hits.get(name), now), path, nbytes)
+        )
+
+    candidates.sort(reverse=True)
+    for _, path, nbytes in candidates:
+        if needed <= 0:
+            break
+        needed -= nbytes
+        yield 'evicted', path
+
+
+def stale_staging(now):
+    """(category, path) of staging directories no run is working in."""
+    names = os.listdir(settings.EXPORT_STAGING_ROOT)
+    for chunk in chunks(n for n in names if is_uuid(n)):
+        for uid in (
+            ExportRun.objects.filter(uid__in=chunk)
+            .exclude(status='RUNNING')
+            .values_list('uid', flat=True)
+        ):
+            yield 'staging', os.path.join(settings.EXPORT_STAGING_ROOT, str(uid))
+    for name in names:
+        path = os.path.join(settings.EXPORT_STAGING_ROOT, name)
+        if (
+            name.startswith('batch-')
+            and now.timestamp() - os.path.getmtime(path) > BATCH_MAX_AGE.total_seconds()
+        ):
+            yield 'batch extract', path
+
+
+def remove(path, dry_run=False):
+    """Remove a directory, returning the bytes it held."""
+    reclaimed = dir_size(path)
+    if not dry_run:
+        shutil.rmtree(path, True)
+    return reclaimed
+
 
 class Command(BaseCommand):
     help = 'remove old downloads'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Report what would be removed'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=WORKERS,
+            help='Number of concurrent deletions',
+        )
+
     def handle(self, *args, **kwargs):
-        def remove_dir(s):
-            shutil.rmtree(os.path.join(settings.EXPORT_DOWNLOAD_ROOT,run_uid),True)
+        now = timezone.now()
+        dry_run = kwargs['dry_run']
+        try:
+            downloads.record_hits()
+            hits = downloads.last_hits()
+        except Exception as ex:
+            self.stderr.write('Download hits unavailable: {0}'.format(ex))
+            hits = {}
+
+        names = os.listdir(settings.EXPORT_DOWNLOAD_ROOT)
+        runs = download_runs(names)
+        expired = list(expired_downloads(names, runs, now))
+        count, reclaimed = self.remove(
+            expired + list(stale_staging(now)), kwargs['workers'], dry_run
+        )
 
-        for run_uid in os.listdir(settings.EXPORT_DOWNLOAD_ROOT):
+        # evict more downloads while the disk is below the free space watermark
+        usage = shutil.disk_usage(settings.EXPORT_DOWNLOAD_ROOT)
+        free = usage.free + (sum(reclaimed.values()) if dry_run else 0)
+        needed = usage.total * settings.DOWNLOAD_FREE_WATERMARK / 100 - free
+        if needed > 0:
+            removed = {os.path.basename(path) for _, path in expired}
+            remaining = [n for n in names if n not in removed]
+            evicted = list(evictions(remaining, runs, now, needed, hits))
+            more_count, more_reclaimed = self.remove(
+                evicted, kwargs['workers'], dry_run
+            )
+            count.update(more_count)
+            reclaimed.update(more_reclaimed)
+            expired += evicted
+
+        if not dry_run:
             try:
-                run = ExportRun.objects.get(uid=run_uid)
-                old = timezone.now() - run.created_at > timedelta(days=30)
-                if old:
-                    if HDXExportRegion.objects.filter(job_id=run.job_id).count() > 0 or PartnerExportRegion.objects.filter(job_id=run.job_id).count() > 0:
-                        if ExportRun.objects.filter(job_id=run.job_id,status='COMPLETED',created_at__gt=run.created_at).count() > 0:
-                            remove_dir(run_uid)
-                    else:
-                        remove_dir(run_uid)
-            except (ExportRun.DoesNotExist, ValidationError):
-                remove_dir(run_uid)
-
-        # Remove not running folders from staging.
-        staging_folders = os.listdir(settings.EXPORT_STAGING_ROOT)
-        uids = [str(r.uid) for r in ExportRun.objects.exclude(status='RUNNING')]
-
-        # Filter.
-        uids = [r for r in uids if r in staging_folders]
-
-        for uid in uids:
-            folder_path = os.path.join(settings.EXPORT_STAGING_ROOT, uid)
-            shutil.rmtree(folder_path, True)
+                downloads.forget(os.path.basename(path) for _, path in expired)
+            except Exception as ex:
+                self.stderr.write('Download hits not cleared: {0}'.format(ex))
+
+        verb = 'Would remove' if dry_run else 'Removed'
+        for category in sorted(count):
+            self.stdout.write(
+                '{0} {1} {2} directories: {3}'.format(
+                    verb, count[category], category, size(reclaimed[category])
+                )
+            )
+        self.stdout.write(
+            '{0} {1} in total'.format(verb, size(sum(reclaimed.values())))
+        )
+
+    def remove(self, removals, workers, dry_run):
+        count = defaultdict(int)
+        reclaimed = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda r: remove(r[1], dry_run), removals)
+            for (category, path), nbytes in zip(removals, results):
+                count[category] += 1
+                reclaimed[category] += nbytes
+        return count, reclaimed
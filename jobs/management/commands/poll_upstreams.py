@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from tasks import freshness
+
+
+class Command(BaseCommand):
+    help = 'Fetch the timestamps and status of Overpass and the Raw Data API into Redis'
+
+    def handle(self, *args, **kwargs):
+        for name, ex in freshness.poll().items():
+            self.stderr.write('{0} not updated: {1}'.format(name, ex))
@@ -0,0 +1,35 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from api.stats import all_days, days_between, refresh_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Refresh the daily rollups behind the stats endpoints for the days that changed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', help='Rebuild the rollups of every day'
+        )
+        parser.add_argument(
+            '--days', type=int, help='Also refresh this many days before today'
+        )
+
+    def handle(self, *args, **kwargs):
+        days = []
+        if kwargs['all']:
+            days = all_days()
+        elif kwargs['days']:
+            today = timezone.localdate()
+            days = days_between(today - timedelta(days=kwargs['days']), today)
+        refreshed = refresh_rollups(days)
+        if refreshed:
+            self.stdout.write(
+                'Refreshed {0} days, {1} to {2}'.format(
+                    len(refreshed), refreshed[0], refreshed[-1]
+                )
+            )
+        else:
+            self.stdout.write('No days to refresh')
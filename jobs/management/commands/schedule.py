@@ -1,42 +1,126 @@
 import os
-import shutil
-from datetime import datetime, timedelta
-import pytz
+import time
+import logging
 from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Q, Subquery
 from django.utils import timezone
 from jobs.models import HDXExportRegion, PartnerExportRegion
-from tasks.task_runners import ExportTaskRunner
+from tasks.task_runners import ExportTaskRunner, batch_extract_scheduled
 from tasks.models import ExportRun
+from tasks.changes import ChangeIndex
+from tasks.scheduling import estimate_durations, plan_delays, scheduled_backlog
 from django.conf import settings
 
+LOG = logging.getLogger(__name__)
+
+# below this many due planet_file regions, each run extracts its own AOI
+BATCH_EXTRACT_MIN = 2
+
 class Command(BaseCommand):
-    help = 'Displays current time'
+    help = 'Enqueue scheduled region runs whose next_run_at has passed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--no-batch-extract',
+            action='store_true',
+            help='Let every planet_file run extract its region from the planet itself',
+        )
+        parser.add_argument(
+            '--run-unchanged',
+            action='store_true',
+            help=(
+                'Run regions even when OSM data in them has not changed '
+                'since their last run'
+            ),
+        )
 
     def handle(self, *args, **kwargs):
 
         now = timezone.now()
+        last_run = ExportRun.objects.filter(job_id=OuterRef('job_id')).order_by(
+            '-created_at'
+        )
+        changes = None
+        if settings.PLANET_CHANGES_INDEX and not kwargs['run_unchanged']:
+            changes = ChangeIndex(settings.PLANET_CHANGES_INDEX)
 
-
+        due = []
         for regioncls in [HDXExportRegion, PartnerExportRegion]:
-            for region in regioncls.objects.exclude(schedule_period='disabled'):
-                schedule_match = False
-                last_run = region.job.runs.last()
-                if last_run:
-                    last_run_status=last_run.status
-                    if last_run_status in ['RUNNING','SUBMITTED']:
-                        continue
-                if region.schedule_period == '6hrs':
-                    schedule_match = (now.hour - region.schedule_hour) % 6 == 0
-                elif region.schedule_period == 'daily':
-                    schedule_match = region.schedule_hour == now.hour
-                elif region.schedule_period == 'weekly':
-                    schedule_match = (now.weekday() + 1) % 7 == 0 and region.schedule_hour == now.hour
-                elif region.schedule_period == '2wks':
-                    schedule_match = now.day in (15, 1) and region.schedule_hour == now.hour
-                elif region.schedule_period == '3wks':
-                    schedule_match = now.day == 21 and region.schedule_hour == now.hour
-                elif region.schedule_period == 'monthly':
-                    schedule_match = now.day == 1 and region.schedule_hour == now.hour
-
-                if schedule_match:
-                    ExportTaskRunner().run_task(job_uid=region.job.uid,ondemand=False)
\ No newline at end of file
+            regions = list(
+                regioncls.objects.exclude(schedule_period='disabled')
+                .filter(next_run_at__lte=now, job__isnull=False)
+                .annotate(
+                    latest_run_status=Subquery(last_run.values('status')[:1]),
+                    latest_run_started_at=Subquery(last_run.values('started_at')[:1]),
+                )
+                .filter(
+                    Q(latest_run_status__isnull=True)
+                    | ~Q(latest_run_status__in=['RUNNING', 'SUBMITTED'])
+                )
+                .select_related('job')
+            )
+            skipped = []
+            for region in regions:
+                due_at = region.next_run_at
+                region.update_next_run(now)
+                if changes and not self.changed(region, changes, due_at):
+                    LOG.info(
+                        'Skipping {0}: no OSM changes since its last run'.format(
+                            region.job.name
+                        )
+                    )
+                    region.last_skipped_at = now
+                    skipped.append(region)
+                else:
+                    due.append(region)
+            regioncls.objects.bulk_update(regions, ['next_run_at'], batch_size=500)
+            regioncls.objects.bulk_update(skipped, ['last_skipped_at'], batch_size=500)
+
+        # shortest expected run first, released as scheduled workers are
+        # expected to free up
+        durations = estimate_durations(due)
+        due.sort(key=lambda r: (durations[r.job_id], r.next_run_at))
+        plan = plan_delays(
+            due,
+            durations,
+            settings.SCHEDULED_WORKERS,
+            settings.SCHEDULE_SPREAD_WINDOW,
+            scheduled_backlog(),
+        )
+
+        # due planet_file regions are cut in one pass over the planet by a
+        # worker, which enqueues their runs once it is done
+        batched = [(region, delay) for region, delay in plan if region.planet_file]
+        if kwargs['no_batch_extract'] or len(batched) < BATCH_EXTRACT_MIN:
+            batched = []
+        for region, delay in plan:
+            if not (batched and region.planet_file):
+                ExportTaskRunner().run_task(
+                    job_uid=region.job.uid, ondemand=False, delay=delay
+                )
+        if batched:
+            batch_dir = os.path.join(
+                settings.EXPORT_STAGING_ROOT,
+                'batch-{0}'.format(now.strftime('%Y%m%d%H')),
+            )
+            planned = [[str(region.job.uid), delay] for region, delay in batched]
+            batch_extract_scheduled.send(batch_dir, planned, time.time())
+
+    def changed(self, region, changes, due_at):
+        """
+        Whether the region must be regenerated, or keeps its last outputs.
+        Only planet_file regions are skipped, and only when the planet was
+        updated after the run was due, so the change index covers that time.
+        """
+        if not region.planet_file:
+            return True
+        applied_at = changes.applied_at
+        if due_at is None or applied_at is None or applied_at < due_at:
+            return True
+        since = region.latest_run_started_at
+        if region.latest_run_status != 'COMPLETED' or since is None:
+            return True
+        job = region.job
+        if job.updated_at >= since:
+            return True
+        return changes.changed_since(job.simplified_geom or job.the_geom, since)
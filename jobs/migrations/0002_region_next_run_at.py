@@ -0,0 +1,32 @@
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def set_next_run_at(apps, schema_editor):
+    now = timezone.now()
+    for model_name in ["HDXExportRegion", "PartnerExportRegion"]:
+        model = apps.get_model("jobs", model_name)
+        regions = list(model.objects.all())
+        for region in regions:
+            region.update_next_run(now)
+        model.objects.bulk_update(regions, ["next_run_at"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="hdxexportregion",
+            name="next_run_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="partnerexportregion",
+            name="next_run_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(set_next_run_at, migrations.RunPython.noop),
+    ]
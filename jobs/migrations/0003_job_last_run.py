@@ -0,0 +1,65 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def set_last_run(apps, schema_editor):
+    Job = apps.get_model("jobs", "Job")
+    ExportRun = apps.get_model("tasks", "ExportRun")
+    runs = (
+        ExportRun.objects.annotate(total_bytes=Sum("tasks__filesize_bytes"))
+        .order_by("job_id", "created_at")
+        .values_list("job_id", "id", "status", "started_at", "finished_at", "total_bytes")
+    )
+    jobs = {}
+    for job_id, run_id, status, started_at, finished_at, total_bytes in runs.iterator():
+        job = jobs.setdefault(job_id, Job(id=job_id))
+        job.last_run_id = run_id
+        job.last_run_status = status
+        if started_at and finished_at:
+            job.last_run_duration = (finished_at - started_at).total_seconds()
+        if finished_at and total_bytes:
+            job.last_run_size = total_bytes
+    Job.objects.bulk_update(
+        jobs.values(),
+        ["last_run", "last_run_status", "last_run_duration", "last_run_size"],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0002_region_next_run_at"),
+        ("tasks", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="last_run",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="tasks.exportrun",
+            ),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="last_run_status",
+            field=models.CharField(blank=True, default="", editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="last_run_duration",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="job",
+            name="last_run_size",
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_last_run, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+def set_kind(apps, schema_editor):
+    Job = apps.get_model("jobs", "Job")
+    for model_name, kind in [("HDXExportRegion", "hdx"), ("PartnerExportRegion", "partner")]:
+        model = apps.get_model("jobs", model_name)
+        Job.objects.filter(id__in=model.objects.values("job_id")).update(kind=kind)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0003_job_last_run"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("plain", "Export"),
+                    ("hdx", "HDX export region"),
+                    ("partner", "Partner export region"),
+                ],
+                db_index=True,
+                default="plain",
+                max_length=10,
+            ),
+        ),
+        migrations.RunPython(set_kind, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0004_job_kind"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="envelope",
+            field=django.contrib.gis.db.models.fields.GeometryField(
+                blank=True, editable=False, null=True, srid=4326
+            ),
+        ),
+        migrations.RunSQL(
+            "UPDATE jobs SET envelope = ST_Envelope(the_geom)",
+            migrations.RunSQL.noop,
+        ),
+    ]
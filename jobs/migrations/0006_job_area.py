@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0005_job_envelope"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="area",
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE jobs SET area = ST_Area(the_geom::geography) / 1000000",
+            migrations.RunSQL.noop,
+        ),
+    ]
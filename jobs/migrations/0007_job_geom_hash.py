@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0006_job_area"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="geom_hash",
+            field=models.CharField(
+                blank=True, db_index=True, default="", editable=False, max_length=32
+            ),
+        ),
+        migrations.RunSQL(
+            "UPDATE jobs SET geom_hash = md5(ST_AsBinary(the_geom, 'NDR') || "
+            "CASE WHEN buffer_aoi THEN '\\x01'::bytea ELSE '\\x00'::bytea END)",
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0007_job_geom_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="country",
+            field=models.CharField(
+                blank=True, db_index=True, default="", editable=False, max_length=2
+            ),
+        ),
+    ]
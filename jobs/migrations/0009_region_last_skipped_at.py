@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0008_job_country"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="hdxexportregion",
+            name="last_skipped_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="partnerexportregion",
+            name="last_skipped_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
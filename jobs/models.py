@@ -1,14 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import calendar
+import hashlib
 from datetime import timedelta
 import logging
 import json
 import uuid
 import re
 import os
-import math
 import time
 from hurry.filesize import size
 from django.contrib.humanize.templatetags import humanize
@@ -16,6 +15,9 @@ from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.db.models.fields import CharField
 from django.utils import timezone
 from django.core.exceptions import ValidationError
@@ -23,6 +25,7 @@ from collections import namedtuple
 import mercantile
 
 from utils.aoi_utils import simplify_geom, force2d
+from utils.reverse_geocode import country_code
 from django.contrib import admin
 
 import rasterio
@@ -39,32 +42,6 @@ RASTER = rasterio.open(os.path.join(DIR, "osm_nodes.tif"))
 Group.add_to_class("is_partner", models.BooleanField(null=False, default=False))
 
 
-def get_geodesic_area(geom):
-    bbox = geom.envelope
-    """
-    Uses the algorithm to calculate geodesic area of a polygon from OpenLayers 2.
-    See http://bit.ly/1Mite1X.
-
-    Args:
-        geom (GEOSGeometry): the export extent as a GEOSGeometry.
-
-    Returns
-        area (float): the geodesic area of the provided geometry.
-    """
-    area = 0.0
-    coords = bbox.coords[0]
-    length = len(coords)
-    if length > 2:
-        for x in range(length - 1):
-            p1 = coords[x]
-            p2 = coords[x + 1]
-            area += math.radians(p2[0] - p1[0]) * (
-                2 + math.sin(math.radians(p1[1])) + math.sin(math.radians(p2[1]))
-            )
-        area = abs(int(area * 6378137 * 6378137 / 2.0 / 1000 / 1000))
-    return area
-
-
 MAX_NODES = 15000000
 ValidateResult = namedtuple("ValidateResult", ["valid", "message", "params"])
 
@@ -159,6 +136,22 @@ def validate_mbtiles(job):
             )
 
 
+JOB_KINDS = (
+    ("plain", "Export"),
+    ("hdx", "HDX export region"),
+    ("partner", "Partner export region"),
+)
+
+
+def geom_digest(geom, buffer_aoi):
+    """
+    md5 of the geometry's WKB and the buffer flag, the same as
+    md5(ST_AsBinary(the_geom) || buffer_aoi) in SQL.
+    """
+    flag = b"\x01" if buffer_aoi else b"\x00"
+    return hashlib.md5(bytes(geom.wkb) + flag).hexdigest()
+
+
 class Job(models.Model):
     """
     Database model for an 'Export'.
@@ -187,6 +180,18 @@ class Job(models.Model):
     simplified_geom = models.GeometryField(
         verbose_name="Simplified geometry", srid=4326, blank=True, null=True
     )
+    # bounding box of the_geom, with its own spatial index for bbox searches
+    envelope = models.GeometryField(srid=4326, blank=True, null=True, editable=False)
+    # geodesic area of the_geom in km², computed by PostGIS on save
+    area = models.FloatField(blank=True, null=True, db_index=True, editable=False)
+    # digest of the_geom and buffer_aoi the fields above were derived from
+    geom_hash = models.CharField(
+        max_length=32, blank=True, default="", db_index=True, editable=False
+    )
+    # ISO code of the country nearest to the centroid of the_geom
+    country = models.CharField(
+        max_length=2, blank=True, default="", db_index=True, editable=False
+    )
     feature_selection = models.TextField(
         blank=False, validators=[validate_feature_selection]
     )
@@ -204,26 +209,39 @@ class Job(models.Model):
     pinned = models.BooleanField(default=False)
     unfiltered = models.BooleanField(default=False)
     preserve_geom = models.BooleanField(default=False)
+    # whether the job belongs to a region, kept by the region models
+    kind = models.CharField(
+        max_length=10, choices=JOB_KINDS, default="plain", db_index=True
+    )
+
+    # the newest run, kept up to date by ExportRun.save
+    last_run = models.ForeignKey(
+        "tasks.ExportRun",
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        on_delete=models.SET_NULL,
+    )
+    last_run_status = models.CharField(
+        max_length=20, blank=True, default="", editable=False
+    )
+    # seconds and bytes of the newest run that finished with a duration/size
+    last_run_duration = models.FloatField(null=True, blank=True, editable=False)
+    last_run_size = models.BigIntegerField(null=True, blank=True, editable=False)
 
     class Meta:  # pragma: no cover
         managed = True
         db_table = "jobs"
 
-    @property
-    def last_run_status(self):
-        if self.runs.count() > 0:
-            return self.runs.all()[self.runs.count() - 1].status
-
     @property
     def last_run_date(self):
-        if self.runs.count() > 0:
-            return self.runs.all()[self.runs.count() - 1].started_at
+        if self.last_run:
+            return self.last_run.started_at
 
     @property
     def is_hdx(self):
-        if HDXExportRegion.objects.filter(job_id=self.id).exists():
-            return True
-        return False
+        return self.kind == "hdx"
 
     @property
     def osma_link(self):
@@ -232,16 +250,39 @@ class Job(models.Model):
             *bounds
         )
 
-    @property
-    def area(self):
-        return get_geodesic_area(self.the_geom)
-
     def save(self, *args, **kwargs):
+        digest = geom_digest(self.the_geom, self.buffer_aoi)
+        if digest == self.geom_hash:
+            super(Job, self).save(*args, **kwargs)
+            return
+
         self.the_geom = force2d(self.the_geom)
+        self.geom_hash = geom_digest(self.the_geom, self.buffer_aoi)
+        # clones share the geometry of the job they were made from
+        derived = (
+            Job.objects.filter(geom_hash=self.geom_hash, area__isnull=False)
+            .exclude(pk=self.pk)
+            .values_list("simplified_geom", "envelope", "area", "country")
+            .first()
+        )
+        if derived:
+            self.simplified_geom, self.envelope, self.area, self.country = derived
+            super(Job, self).save(*args, **kwargs)
+            return
+
+        self.envelope = self.the_geom.envelope
+        self.country = country_code(self.the_geom)
         self.simplified_geom = simplify_geom(
             self.the_geom, force_buffer=self.buffer_aoi
         )
         super(Job, self).save(*args, **kwargs)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET area = ST_Area(the_geom::geography) / 1000000 "
+                "WHERE id = %s RETURNING area",
+                [self.id],
+            )
+            self.area = cursor.fetchone()[0]
 
     def __str__(self):
         return str(self.uid)
@@ -284,53 +325,31 @@ PERIOD_CHOICES = (
     ("disabled", "Disabled"),
 )
 HOUR_CHOICES = list(zip(range(0, 24), range(0, 24)))
+# months between the runs of the periods anchored on calendar months
+PERIOD_MONTHS = {"monthly": 1, "quarterly": 3, "semiyearly": 6, "yearly": 12}
 
 
 class RegionMixin:
     @property
     def last_run(self):  # noqa
-        if self.job.runs.count() > 0:
-            last_run_time = (
-                self.job.runs.all()[self.job.runs.count() - 1].finished_at
-                or self.job.runs.all()[self.job.runs.count() - 1].started_at
-                or self.job.runs.all()[self.job.runs.count() - 1].created_at
-            )
-            return last_run_time
+        run = self.job.last_run
+        if run:
+            return run.finished_at or run.started_at or run.created_at
 
     @property
     def last_run_status(self):
-        if self.job.runs.count() > 0:
-            return self.job.runs.all()[self.job.runs.count() - 1].status
+        if self.job.last_run_id:
+            return self.job.last_run_status
 
     @property
     def last_run_duration(self):
-        if self.job.runs.count() > 0:
-            i = 1
-            last_run_duration = None
-            while (
-                last_run_duration is None
-            ):  # get previous run size if current is running/submitted
-                if i >= self.job.runs.count() and i != 1:
-                    break
-                last_run_duration = self.job.runs.all()[
-                    self.job.runs.count() - i
-                ].duration
-                i += 1
-            return time.strftime("%H:%M:%S", time.gmtime(last_run_duration))
+        if self.job.last_run_duration is not None:
+            return time.strftime("%H:%M:%S", time.gmtime(self.job.last_run_duration))
 
     @property
     def last_size(self):
-        if self.job.runs.count() > 0:
-            i = 1
-            last_run_size = 0
-            while (
-                last_run_size == 0
-            ):  # get previous run size if current is running/submitted
-                if i >= self.job.runs.count() and i != 1:
-                    break
-                last_run_size = self.job.runs.all()[self.job.runs.count() - i].size
-                i += 1
-            return last_run_size
+        if self.job.last_run_id:
+            return self.job.last_run_size or 0
 
     @property
     def last_export_size(self):
@@ -339,8 +358,9 @@ class RegionMixin:
 
     @property
     def last_run_hdx_sync(self):
-        if self.job.runs.count() > 0:
-            return self.job.runs.all()[self.job.runs.count() - 1].hdx_sync_status
+        run = self.job.last_run
+        if run:
+            return run.hdx_sync_status
 
     @property
     def next_run_hum(self):
@@ -352,10 +372,41 @@ class RegionMixin:
 
     @property
     def next_run(self):  # noqa
-        now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        return self.next_run_at or self.next_run_after(timezone.now())
+
+    def update_next_run(self, current_time=None):
+        """Store the first scheduled run after current_time in next_run_at."""
+        self.next_run_at = self.next_run_after(current_time or timezone.now())
+
+    def set_job_kind(self, kind):
+        """Store kind on the region's job, plain when the region is deleted."""
+        if self.job_id is None:
+            return
+        Job.objects.filter(id=self.job_id).exclude(kind=kind).update(kind=kind)
+        if "job" in self._state.fields_cache:
+            self.job.kind = kind
+
+    def schedule_changed(self, update_fields=None):
+        """Whether schedule_period or schedule_hour differ from the stored ones."""
+        if update_fields is not None and not {"schedule_period", "schedule_hour"} & set(
+            update_fields
+        ):
+            return False
+        if self._state.adding or self.pk is None:
+            return True
+        stored = (
+            type(self)
+            .objects.filter(pk=self.pk)
+            .values_list("schedule_period", "schedule_hour")
+            .first()
+        )
+        return stored != (self.schedule_period, self.schedule_hour)
+
+    def next_run_after(self, current_time):  # noqa
+        now = current_time.replace(minute=0, second=0, microsecond=0)
 
         if self.schedule_period == "6hrs":
-            delta = 6 - (self.schedule_hour + now.hour % 6)
+            delta = (self.schedule_hour - now.hour) % 6 or 6
 
             return now + timedelta(hours=delta)
 
@@ -364,7 +415,7 @@ class RegionMixin:
         if self.schedule_period == "daily":
             anchor = now
 
-            if timezone.now() < anchor:
+            if current_time < anchor:
                 return anchor
 
             return anchor + timedelta(days=1)
@@ -373,7 +424,7 @@ class RegionMixin:
             # adjust so the week starts on Sunday
             anchor = now - timedelta((now.weekday() + 1) % 7)
 
-            if timezone.now() < anchor:
+            if current_time < anchor:
                 return anchor
 
             return anchor + timedelta(days=7)
@@ -382,7 +433,7 @@ class RegionMixin:
             # adjust so the week starts on Sunday
             anchor = now - timedelta((now.weekday() + 1) % 7)
 
-            if timezone.now() < anchor:
+            if current_time < anchor:
                 return anchor
 
             return anchor + timedelta(days=14)
@@ -391,46 +442,21 @@ class RegionMixin:
             # adjust so the week starts on Sunday
             anchor = now - timedelta((now.weekday() + 1) % 7)
 
-            if timezone.now() < anchor:
+            if current_time < anchor:
                 return anchor
 
             return anchor + timedelta(days=21)
 
-        if self.schedule_period == "monthly":
-            (_, num_days) = calendar.monthrange(now.year, now.month)
-            anchor = now.replace(day=1)
-
-            if timezone.now() < anchor:
-                return anchor
-
-            return anchor + timedelta(days=num_days)
-
-        if self.schedule_period == "quarterly":
-            # adjust so the week starts on Sunday
-            anchor = now - timedelta((now.weekday() + 1) % 7)
+        if self.schedule_period in PERIOD_MONTHS:
+            # anchor on the first day of the month, quarter, half or year
+            months = PERIOD_MONTHS[self.schedule_period]
+            anchor = now.replace(day=1, month=now.month - (now.month - 1) % months)
 
-            if timezone.now() < anchor:
+            if current_time < anchor:
                 return anchor
 
-            return anchor + timedelta(days=90)
-
-        if self.schedule_period == "semiyearly":
-            # adjust so the week starts on Sunday
-            anchor = now - timedelta((now.weekday() + 1) % 7)
-
-            if timezone.now() < anchor:
-                return anchor
-
-            return anchor + timedelta(days=180)
-
-        if self.schedule_period == "yearly":
-            # adjust so the week starts on Sunday
-            anchor = now - timedelta((now.weekday() + 1) % 7)
-
-            if timezone.now() < anchor:
-                return anchor
-
-            return anchor + timedelta(days=365)
+            month = anchor.month - 1 + months
+            return anchor.replace(year=anchor.year + month // 12, month=month % 12 + 1)
 
     @property
     def delta(self):  # noqa
@@ -497,6 +523,16 @@ class PartnerExportRegion(models.Model, RegionMixin):
     deleted = models.BooleanField(default=False)
     planet_file = models.BooleanField(default=False)
     polygon_centroid = models.BooleanField(default=False)
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # when the schedule last skipped a run, as OSM data in the region had not changed
+    last_skipped_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        if self.schedule_changed(kwargs.get("update_fields")):
+            self.update_next_run()
+        with transaction.atomic():
+            super(PartnerExportRegion, self).save(*args, **kwargs)
+            self.set_job_kind("partner")
 
     @property
     def export_formats(self):  # noqa
@@ -537,6 +573,9 @@ class HDXExportRegion(models.Model, RegionMixin):  # noqa
     subnational = models.BooleanField(default=True)
     extra_notes = models.TextField(null=True, blank=True)
     planet_file = models.BooleanField(default=False)
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # when the schedule last skipped a run, as OSM data in the region had not changed
+    last_skipped_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:  # noqa
         db_table = "hdx_export_regions"
@@ -544,6 +583,13 @@ class HDXExportRegion(models.Model, RegionMixin):  # noqa
     def __str__(self):
         return self.name + " (prefix: " + self.dataset_prefix + ")"
 
+    def save(self, *args, **kwargs):
+        if self.schedule_changed(kwargs.get("update_fields")):
+            self.update_next_run()
+        with transaction.atomic():
+            super(HDXExportRegion, self).save(*args, **kwargs)
+            self.set_job_kind("hdx")
+
     def clean(self):
         if self.job and not re.match(r"^[a-z0-9-_]+$", self.job.name):
             raise ValidationError(
@@ -636,3 +682,10 @@ class HDXExportRegion(models.Model, RegionMixin):  # noqa
             return 365
 
         return -2  # returning as needed as default instead of live
+
+
+@receiver(post_delete, sender=PartnerExportRegion)
+@receiver(post_delete, sender=HDXExportRegion)
+def reset_job_kind(sender, instance, **kwargs):
+    """A deleted region, alone or in a queryset, leaves a plain job."""
+    instance.set_job_kind("plain")
@@ -1,61 +1,533 @@
 import argparse
-import glob
+import hashlib
 import shutil
 import json
 import os
 import logging
+import math
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+import osmium
 from osmium.replication import server
-from datetime import datetime,timezone
+from datetime import datetime,timedelta,timezone
 
 # 0 3 * * * /home/exports/venv/bin/python /home/exports/osm-export-tool/jobs/secondary_pipeline.py /mnt/data/planet/ >> /home/exports/secondary_pipeline.log 2>&1
 
-parser = argparse.ArgumentParser(description='osmium-tool based pipeline')
-parser.add_argument('directory', help='Working directory - needs a lot of space')
-parsed = parser.parse_args()
-workdir = parsed.directory
-planet = os.path.join(workdir,'planet.osm.pbf')
-
 PLANET_OSM_PBF = 'https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf'
+REPLICATION_URL = 'https://planet.openstreetmap.org/replication/day'
+
+DIFF_WORKERS = 4
+PLANET_PARTS = 8
+CHUNK_SIZE = 1024 * 1024
+# bytes of a range written between two records of its progress
+CHECKPOINT = 64 * CHUNK_SIZE
+TIMEOUT = 60
+
+# continent shards cut from the planet after each update, as
+# (min_lon,min_lat,max_lon,max_lat). --shards-config adds or overrides
+# entries, e.g. with country bounding boxes.
+SHARDS = {
+	'africa':(-27.0,-47.0,64.0,38.0),
+	'antarctica':(-180.0,-90.0,180.0,-60.0),
+	'asia':(25.0,-12.0,180.0,82.0),
+	'australia-oceania':(110.0,-56.0,180.0,12.0),
+	'central-america':(-93.0,6.5,-59.0,22.0),
+	'europe':(-32.0,34.0,46.0,82.0),
+	'north-america':(-180.0,5.0,-50.0,84.0),
+	'south-america':(-83.0,-57.0,-33.0,13.5),
+}
+
+# size in degrees of the grid cells changes/index.json records edits in, and
+# how long planet updates stay in it
+CHANGE_CELL = 0.1
+CHANGES_RETENTION = timedelta(days=35)
+
+_local = threading.local()
+
+def get_session():
+	# one pooled session per download thread
+	if not hasattr(_local,'session'):
+		_local.session = requests.Session()
+	return _local.session
+
+def fetch(url,path,session=None):
+	"""
+	Download url to path, resuming a partial file left by an earlier attempt.
+	Raises IOError if the result does not match the size reported by the server.
+	"""
+	session = session or get_session()
+	head = session.head(url,allow_redirects=True,timeout=TIMEOUT)
+	head.raise_for_status()
+	expected = int(head.headers['Content-Length'])
+
+	offset = os.path.getsize(path) if os.path.isfile(path) else 0
+	if offset == expected:
+		return path
+	if offset > expected:
+		offset = 0
+
+	headers = {'Range':'bytes={0}-'.format(offset)} if offset else {}
+	with session.get(url,headers=headers,stream=True,timeout=TIMEOUT) as r:
+		r.raise_for_status()
+		if r.status_code != 206:
+			offset = 0
+		with open(path,'ab' if offset else 'wb') as f:
+			for chunk in r.iter_content(CHUNK_SIZE):
+				f.write(chunk)
+
+	actual = os.path.getsize(path)
+	if actual != expected:
+		raise IOError('{0}: expected {1} bytes, got {2}'.format(url,expected,actual))
+	return path
+
+def fetch_range(url,path,start,end,offset=0,progress=None,session=None):
+	"""
+	Download bytes start+offset..end (inclusive) of url into the
+	preallocated file at path, each at its own position in the file.
+	progress(written) is called with the bytes of the range on disk every
+	CHECKPOINT bytes, so an interrupted download resumes from there.
+	"""
+	session = session or get_session()
+	expected = end - start + 1
+	written = min(offset,expected)
+	if written < expected:
+		headers = {'Range':'bytes={0}-{1}'.format(start + written,end)}
+		with session.get(url,headers=headers,stream=True,timeout=TIMEOUT) as r:
+			r.raise_for_status()
+			if r.status_code != 206:
+				raise IOError('{0}: server ignored the Range request'.format(url))
+			with open(path,'r+b') as f:
+				f.seek(start + written)
+				checkpoint = written
+				for chunk in r.iter_content(CHUNK_SIZE):
+					chunk = chunk[:expected - written]
+					f.write(chunk)
+					written += len(chunk)
+					if progress and written - checkpoint >= CHECKPOINT:
+						f.flush()
+						os.fsync(f.fileno())
+						progress(written)
+						checkpoint = written
+				f.flush()
+				os.fsync(f.fileno())
+
+	if written != expected:
+		raise IOError('{0}: expected {1} bytes in range {2}-{3}, got {4}'.format(
+			url,expected,start,end,written))
+	if progress:
+		progress(written)
+	return path
+
+def fetch_whole(url,path,session=None):
+	"""Download url to path in a single plain GET, for servers without Range support."""
+	session = session or get_session()
+	with session.get(url,stream=True,timeout=TIMEOUT) as r:
+		r.raise_for_status()
+		with open(path,'wb') as f:
+			for chunk in r.iter_content(CHUNK_SIZE):
+				f.write(chunk)
+	return path
+
+def file_md5(path):
+	digest = hashlib.md5()
+	with open(path,'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE),b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def preallocate(path,length):
+	with open(path,'wb') as f:
+		f.truncate(length)
+		try:
+			# reserve the space now rather than fail on a full disk midway
+			os.posix_fallocate(f.fileno(),0,length)
+		except (AttributeError,OSError):
+			pass
+
+def fetch_md5(url,session=None):
+	# planet .md5 files look like "<hexdigest>  planet-YYMMDD.osm.pbf"
+	session = session or get_session()
+	r = session.get(url,timeout=TIMEOUT)
+	r.raise_for_status()
+	return r.text.split()[0].lower()
+
+def download_planet(url,path,parts=PLANET_PARTS,md5_url=None):
+	"""
+	Download url to path using several concurrent Range requests, each
+	writing its range at its offset in one preallocated path.download file.
+	The bytes each range has on disk are recorded in path.parts.json, so an
+	interrupted download resumes. Servers without Range support get a single
+	plain GET. path is only written once the download matches the published md5.
+	"""
+	session = get_session()
+	head = session.head(url,allow_redirects=True,timeout=TIMEOUT)
+	head.raise_for_status()
+	# pin the resolved url so every range and the md5 come from the same file
+	url = head.url
+	md5 = fetch_md5(md5_url or url + '.md5',session)
+	length = int(head.headers['Content-Length'])
+	download = path + '.download'
+	meta_path = path + '.parts.json'
+
+	if head.headers.get('Accept-Ranges') != 'bytes':
+		logging.warning("Downloading {0} bytes without Range support".format(length))
+		fetch_whole(url,download,session)
+	else:
+		parts = max(1,min(parts,length))
+		meta = {'md5':md5,'length':length,'parts':parts}
+		state = read_state(meta_path)
+		resumable = (
+			{key:state.get(key) for key in meta} == meta
+			and os.path.isfile(download)
+			and os.path.getsize(download) == length
+		)
+		if not resumable:
+			preallocate(download,length)
+			state = dict(meta,done=[0] * parts)
+			write_state(meta_path,state)
+
+		size = -(-length // parts)
+		ranges = [(i * size,min(length,(i + 1) * size) - 1) for i in range(parts)]
+		lock = threading.Lock()
+
+		def progress(i):
+			def record(written):
+				with lock:
+					state['done'][i] = written
+					write_state(meta_path,state)
+			return record
+
+		logging.warning("Downloading {0} bytes in {1} parts".format(length,parts))
+		with ThreadPoolExecutor(max_workers=parts) as executor:
+			futures = [
+				executor.submit(fetch_range,url,download,start,end,state['done'][i],progress(i))
+				for i,(start,end) in enumerate(ranges)
+			]
+			for future in futures:
+				future.result()
+
+	digest = file_md5(download)
+	if digest != md5:
+		os.remove(download)
+		if os.path.isfile(meta_path):
+			os.remove(meta_path)
+		raise IOError('{0}: md5 mismatch, expected {1} got {2}'.format(url,md5,digest))
+
+	os.rename(download,path)
+	if os.path.isfile(meta_path):
+		os.remove(meta_path)
+	return path
+
+def read_state(state_path):
+	try:
+		with open(state_path) as f:
+			return json.load(f)
+	except (IOError,ValueError):
+		return {}
+
+def write_state(state_path,state):
+	tmp_path = state_path + '.tmp'
+	with open(tmp_path,'w') as f:
+		json.dump(state,f)
+	os.replace(tmp_path,state_path)
+
+def download_diffs(replication,first,last,tmpdir,workers=DIFF_WORKERS):
+	"""
+	Download the diffs first..last into tmpdir using a bounded pool of threads.
+	Completed sequence numbers are recorded in tmpdir/state.json, so a failed
+	run picks up where it stopped. Returns the diff paths in sequence order.
+	"""
+	state_path = os.path.join(tmpdir,'state.json')
+	state = read_state(state_path)
+	if state.get('first') != first:
+		state = {'first':first,'done':[]}
+	done = set(state['done'])
 
-if not os.path.isfile(planet):
-	logging.warning('Downloading planet.osm.pbf')
-	subprocess.call(['wget','-O',planet,PLANET_OSM_PBF])
+	def diff_path(seq):
+		return os.path.join(tmpdir,'{0}.osc.gz'.format(seq))
 
-fileinfo = json.loads(subprocess.check_output(['osmium','fileinfo','-j',planet]))
-option = fileinfo['header']['option']
-daily = server.ReplicationServer('https://planet.openstreetmap.org/replication/day')
+	def download(seq):
+		fetch(replication.get_diff_url(seq),diff_path(seq))
+		return seq
 
-if 'osmosis_replication_sequence_number' in option:
-	seqnum = int(option['osmosis_replication_sequence_number'])
-else:
-	timestamp = fileinfo['header']['option']['osmosis_replication_timestamp']
+	pending = [seq for seq in range(first,last+1) if seq not in done]
+	present = last - first + 1 - len(pending)
+	logging.warning("Downloading {0} diffs ({1} already present)".format(len(pending),present))
+	failed = []
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(download,seq):seq for seq in pending}
+		for future in as_completed(futures):
+			seq = futures[future]
+			try:
+				future.result()
+			except Exception as ex:
+				logging.warning("Diff {0} failed: {1}".format(seq,ex))
+				failed.append(seq)
+				continue
+			done.add(seq)
+			state['done'] = sorted(done)
+			write_state(state_path,state)
+
+	if failed:
+		raise IOError('Failed to download diffs {0}'.format(sorted(failed)))
+	return [diff_path(seq) for seq in range(first,last+1)]
+
+def planet_header(planet):
+	fileinfo = json.loads(subprocess.check_output(['osmium','fileinfo','-j',planet]))
+	return fileinfo['header']['option']
+
+def has_locations_on_ways(option):
+	return 'LocationsOnWays' in option.values()
+
+def add_locations_to_ways(workdir,planet):
+	"""
+	Rewrite the planet with node locations stored on its ways, so extracts
+	and handlers reading it do not need to build a node location index.
+	Untagged nodes are kept for the tools that still read them.
+	"""
+	converted = os.path.join(workdir,'planet-locations.osm.pbf')
+	index = os.path.join(workdir,'locations.idx')
+	subprocess.check_call([
+		'osmium','add-locations-to-ways','--overwrite','--keep-untagged-nodes',
+		'-i','dense_file_array,{0}'.format(index),planet,'-o',converted
+	])
+	os.remove(index)
+	os.rename(converted,planet)
+
+def planet_sequence(option,replication):
+	if 'osmosis_replication_sequence_number' in option:
+		return int(option['osmosis_replication_sequence_number'])
+
+	timestamp = option['osmosis_replication_timestamp']
 	timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
 	timestamp = timestamp.replace(tzinfo=timezone.utc)
 	logging.warning("Timestamp is {0}".format(timestamp))
-	seqnum = daily.timestamp_to_sequence(timestamp)
-
-logging.warning("Seqnum is {0}".format(seqnum))
-latest = daily.get_state_info().sequence
-logging.warning("Latest is {0}".format(latest))
-if seqnum == latest:
-	exit(0)
-
-try:
-	os.mkdir(os.path.join(workdir,'tmp'))
-except:
-	pass
-
-try:
-	for i in range(seqnum+1,latest+1):
-		subprocess.call(['wget','-O',os.path.join(workdir,'tmp','{0}.osc.gz'.format(i)),daily.get_diff_url(i)])
-
-	g = glob.glob(os.path.join(workdir,'tmp','*.osc.gz'))
-	subprocess.call(['osmium','merge-changes','--overwrite','--simplify',*g,'-o',os.path.join(workdir,'merged-changes.osc.gz')])
-	subprocess.call(['osmium','apply-changes','--output-header','osmosis_replication_sequence_number={0}'.format(latest),planet,os.path.join(workdir,'merged-changes.osc.gz'),'-o',os.path.join(workdir,'planet-updated.osm.pbf')])
-	os.rename(os.path.join(workdir,'planet-updated.osm.pbf'),planet)
-except:
-	pass
-finally:
-	shutil.rmtree(os.path.join(workdir,'tmp'))
+	return replication.timestamp_to_sequence(timestamp)
+
+class ChangedCells(osmium.SimpleHandler):
+	"""
+	Grid cells of the node locations read, and the ids of the nodes and
+	member ways the ways and relations read need to be located.
+	"""
+	def __init__(self,cell=CHANGE_CELL):
+		super().__init__()
+		self.cell = cell
+		self.cells = set()
+		self.nodes = set()
+		self.ways = set()
+
+	def node(self,n):
+		if n.location.valid():
+			self.cells.add((math.floor(n.location.lon / self.cell),math.floor(n.location.lat / self.cell)))
+
+	def way(self,w):
+		self.nodes.update(node.ref for node in w.nodes)
+
+	def relation(self,r):
+		for member in r.members:
+			if member.type == 'n':
+				self.nodes.add(member.ref)
+			elif member.type == 'w':
+				self.ways.add(member.ref)
+
+def get_objects(workdir,source,prefix,ids,output):
+	"""Copy the objects of source with these ids (of type prefix n or w) to output."""
+	id_file = os.path.join(workdir,'ids.txt')
+	with open(id_file,'w') as f:
+		f.writelines('{0}{1}\n'.format(prefix,i) for i in sorted(ids))
+	# getid exits with 1 when some IDs are not found, as with deleted objects
+	if subprocess.call(['osmium','getid','--overwrite','-i',id_file,source,'-o',output]) > 1:
+		raise IOError('osmium getid failed on {0}'.format(source))
+	os.remove(id_file)
+	return output
+
+def change_cells(workdir,planet,updated,merged):
+	"""
+	Grid cells touched by the changes in merged, from the planet before and
+	after they were applied: the old and new locations of changed nodes, and
+	those of every node of the old and new versions of changed ways, and of
+	the member ways and nodes of changed relations. Member relations are not
+	followed.
+	"""
+	handler = ChangedCells()
+	handler.apply_file(merged)
+	old = os.path.join(workdir,'changed-objects.osm.pbf')
+	# getid exits with 1 when some IDs are not found, as with created objects
+	if subprocess.call(['osmium','getid','--overwrite','-I',merged,planet,'-o',old]) > 1:
+		raise IOError('osmium getid failed on {0}'.format(merged))
+	handler.apply_file(old)
+	os.remove(old)
+
+	located = os.path.join(workdir,'located-objects.osm.pbf')
+	if handler.ways:
+		handler.apply_file(get_objects(workdir,updated,'w',handler.ways,located))
+	if handler.nodes:
+		handler.apply_file(get_objects(workdir,updated,'n',handler.nodes,located))
+	if os.path.isfile(located):
+		os.remove(located)
+	return handler.cells
+
+def write_changes(changes_dir,entry,cells,now=None):
+	"""
+	Add the cells changed by one planet update to changes_dir/index.json,
+	dropping updates recorded more than CHANGES_RETENTION ago. applied_at
+	stays empty until mark_applied is called once the planet is updated.
+	"""
+	now = now or datetime.now(timezone.utc)
+	os.makedirs(changes_dir,exist_ok=True)
+	path = '{0}-{1}.json'.format(entry['first'],entry['last'])
+	entry = dict(entry,recorded_at=now.isoformat(),applied_at=None,path=path)
+	write_state(os.path.join(changes_dir,entry['path']),{'cell_size':CHANGE_CELL,'cells':sorted(cells)})
+
+	index_path = os.path.join(changes_dir,'index.json')
+	entries = [e for e in read_state(index_path).get('updates',[]) if e['path'] != entry['path']] + [entry]
+	kept = [e for e in entries if now - datetime.fromisoformat(e['recorded_at']) <= CHANGES_RETENTION]
+	write_state(index_path,{'cell_size':CHANGE_CELL,'updates':kept})
+	for e in entries:
+		if e not in kept and os.path.isfile(os.path.join(changes_dir,e['path'])):
+			os.remove(os.path.join(changes_dir,e['path']))
+	return entry
+
+def mark_applied(changes_dir,sequence,now=None):
+	"""Mark the updates up to sequence as readable from the planet and its shards."""
+	now = now or datetime.now(timezone.utc)
+	index_path = os.path.join(changes_dir,'index.json')
+	index = read_state(index_path)
+	if not index:
+		return
+	for e in index['updates']:
+		if e['applied_at'] is None and e['last'] <= sequence:
+			e['applied_at'] = now.isoformat()
+	write_state(index_path,index)
+
+def update_planet(workdir,planet,workers=DIFF_WORKERS,changes_dir=None):
+	daily = server.ReplicationServer(REPLICATION_URL)
+	option = planet_header(planet)
+	seqnum = planet_sequence(option,daily)
+	logging.warning("Seqnum is {0}".format(seqnum))
+	latest = daily.get_state_info().sequence
+	logging.warning("Latest is {0}".format(latest))
+	if seqnum == latest:
+		return latest,False
+
+	tmpdir = os.path.join(workdir,'tmp')
+	os.makedirs(tmpdir,exist_ok=True)
+
+	# tmpdir is only removed once the planet is updated, so that a failed run
+	# can resume its downloads.
+	diffs = download_diffs(daily,seqnum+1,latest,tmpdir,workers)
+	merged = os.path.join(workdir,'merged-changes.osc.gz')
+	updated = os.path.join(workdir,'planet-updated.osm.pbf')
+	subprocess.check_call(['osmium','merge-changes','--overwrite','--simplify',*diffs,'-o',merged])
+	apply_changes = [
+		'osmium','apply-changes','--overwrite',
+		'--output-header','osmosis_replication_sequence_number={0}'.format(latest),
+		planet,merged,'-o',updated
+	]
+	if has_locations_on_ways(option):
+		apply_changes.append('--locations-on-ways')
+	subprocess.check_call(apply_changes)
+	# recorded before the updated planet replaces the old one, so that no
+	# applied update is missing from the index; main marks it applied once
+	# the shards are cut
+	if changes_dir:
+		write_changes(changes_dir,{
+			'first':seqnum+1,
+			'last':latest,
+			'start':daily.get_state_info(seqnum).timestamp.isoformat(),
+			'end':daily.get_state_info(latest).timestamp.isoformat(),
+		},change_cells(workdir,planet,updated,merged))
+	os.rename(updated,planet)
+	shutil.rmtree(tmpdir)
+	return latest,True
+
+def build_shards(planet,shards_dir,shards,sequence,locations_on_ways=False):
+	"""
+	Cut every shard from the planet in a single osmium extract pass, then
+	move them into shards_dir and rewrite shards_dir/index.json, the bounds
+	index the task runner uses to pick the smallest shard covering an AOI.
+	"""
+	tmpdir = os.path.join(shards_dir,'tmp')
+	os.makedirs(tmpdir,exist_ok=True)
+	output_format = 'pbf,locations_on_ways=true' if locations_on_ways else 'pbf'
+	config_path = os.path.join(tmpdir,'extracts.json')
+	with open(config_path,'w') as f:
+		json.dump({
+			'directory':tmpdir,
+			'extracts':[
+				{'output':'{0}.osm.pbf'.format(name),'output_format':output_format,'bbox':list(bbox)}
+				for name,bbox in shards.items()
+			]
+		},f)
+	subprocess.check_call(['osmium','extract','--overwrite','-s','smart','-c',config_path,planet])
+
+	index = {'sequence':sequence,'locations_on_ways':locations_on_ways,'shards':[]}
+	for name,bbox in sorted(shards.items()):
+		filename = '{0}.osm.pbf'.format(name)
+		os.replace(os.path.join(tmpdir,filename),os.path.join(shards_dir,filename))
+		index['shards'].append({'name':name,'path':filename,'bbox':list(bbox)})
+	write_state(os.path.join(shards_dir,'index.json'),index)
+	shutil.rmtree(tmpdir)
+
+def shards_stale(index,shards,sequence,locations_on_ways):
+	"""True if the shards of index were not cut with these extents from the planet at sequence."""
+	extents = {shard['name']:tuple(shard['bbox']) for shard in index.get('shards',[])}
+	return (
+		index.get('sequence') != sequence
+		or index.get('locations_on_ways',False) != locations_on_ways
+		or extents != {name:tuple(bbox) for name,bbox in shards.items()}
+	)
+
+def load_shards(config_path=None):
+	shards = dict(SHARDS)
+	if config_path:
+		with open(config_path) as f:
+			shards.update({name:tuple(bbox) for name,bbox in json.load(f).items()})
+	return shards
+
+def main():
+	parser = argparse.ArgumentParser(description='osmium-tool based pipeline')
+	parser.add_argument('directory', help='Working directory - needs a lot of space')
+	parser.add_argument('--workers', type=int, default=DIFF_WORKERS,
+		help='Number of concurrent diff downloads')
+	parser.add_argument('--parts', type=int, default=PLANET_PARTS,
+		help='Number of concurrent ranges for the planet download')
+	parser.add_argument('--shards-config',
+		help='JSON file of extra {"name":[min_lon,min_lat,max_lon,max_lat]} shards')
+	parser.add_argument('--no-shards', action='store_true', help='Do not maintain regional shards')
+	parser.add_argument('--no-changes', action='store_true',
+		help='Do not record where each update changed the planet')
+	parser.add_argument('--locations-on-ways', action='store_true',
+		help='Keep node locations on the ways of the planet and its shards')
+	parsed = parser.parse_args()
+	workdir = parsed.directory
+	planet = os.path.join(workdir,'planet.osm.pbf')
+	shards_dir = os.path.join(workdir,'shards')
+
+	try:
+		if not os.path.isfile(planet):
+			logging.warning('Downloading planet.osm.pbf')
+			download_planet(PLANET_OSM_PBF,planet,parsed.parts)
+		locations_on_ways = has_locations_on_ways(planet_header(planet))
+		if parsed.locations_on_ways and not locations_on_ways:
+			logging.warning('Adding locations to ways')
+			add_locations_to_ways(workdir,planet)
+			locations_on_ways = True
+		changes_dir = None if parsed.no_changes else os.path.join(workdir,'changes')
+		sequence,updated = update_planet(workdir,planet,parsed.workers,changes_dir)
+		if not parsed.no_shards:
+			shards = load_shards(parsed.shards_config)
+			index = read_state(os.path.join(shards_dir,'index.json'))
+			if updated or shards_stale(index,shards,sequence,locations_on_ways):
+				logging.warning('Building {0} shards'.format(len(shards)))
+				build_shards(planet,shards_dir,shards,sequence,locations_on_ways)
+		if changes_dir:
+			mark_applied(changes_dir,sequence)
+	except Exception:
+		logging.exception('Planet update failed')
+		exit(1)
 
+if __name__ == '__main__':
+	main()
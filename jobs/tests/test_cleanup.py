@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from feature_selection.feature_selection import FeatureSelection
+from jobs.management.commands import cleanup
+from jobs.models import HDXExportRegion, Job
+from tasks.models import ExportRun
+
+
+class TestCleanup(TestCase):
+    def setUp(self):
+        self.download_root = tempfile.mkdtemp()
+        self.staging_root = tempfile.mkdtemp()
+        self.settings = override_settings(
+            EXPORT_DOWNLOAD_ROOT=self.download_root, EXPORT_STAGING_ROOT=self.staging_root
+        )
+        self.settings.enable()
+        self.user = User.objects.create(username="demo", email="demo@demo.com", password="demo")
+        self.job = self.create_job("job")
+        self.region_job = self.create_job("region", kind="hdx")
+        HDXExportRegion.objects.create(job=self.region_job, schedule_period="daily")
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.download_root)
+        shutil.rmtree(self.staging_root)
+
+    def create_job(self, name, kind="plain"):
+        return Job.objects.create(
+            name=name,
+            kind=kind,
+            user=self.user,
+            the_geom=Polygon.from_bbox((-10.80029, 6.3254236, -10.79809, 6.32752)),
+            export_formats=["shp"],
+            feature_selection=FeatureSelection.example("simple"),
+        )
+
+    def create_run(self, job, days, status="COMPLETED", root=None):
+        run = ExportRun.objects.create(
+            job=job,
+            user=self.user,
+            status=status,
+            created_at=timezone.now() - timedelta(days=days),
+        )
+        path = os.path.join(root or self.download_root, str(run.uid))
+        os.makedirs(path)
+        with open(os.path.join(path, "export.zip"), "wb") as f:
+            f.write(b"0" * 1024)
+        return path
+
+    def test_cleanup(self):
+        expired = self.create_run(self.job, 40)
+        recent = self.create_run(self.job, 1)
+        superseded = self.create_run(self.region_job, 50)
+        latest = self.create_run(self.region_job, 40)
+        orphaned = os.path.join(self.download_root, str(uuid.uuid4()))
+        os.makedirs(orphaned)
+        running = self.create_run(self.job, 0, "RUNNING", self.staging_root)
+        failed = self.create_run(self.job, 0, "FAILED", self.staging_root)
+
+        out = StringIO()
+        call_command("cleanup", "--dry-run", stdout=out)
+        self.assertIn("Would remove 1 superseded region directories: 1K", out.getvalue())
+        self.assertTrue(os.path.isdir(expired))
+
+        call_command("cleanup", stdout=StringIO())
+        for path in [expired, superseded, orphaned, failed]:
+            self.assertFalse(os.path.exists(path))
+        for path in [recent, latest, running]:
+            self.assertTrue(os.path.isdir(path))
+
+    def test_evictions(self):
+        now = timezone.now()
+
+        def run(age, region=False, superseded=False):
+            return {
+                "created_at": now - age,
+                "status": "COMPLETED",
+                "region": region,
+                "superseded": superseded,
+            }
+
+        runs = {
+            "idle": run(timedelta(days=10)),
+            "popular": run(timedelta(days=10)),
+            "superseded": run(timedelta(days=3), region=True, superseded=True),
+            "latest": run(timedelta(days=10), region=True),
+            "new": run(timedelta(hours=1)),
+        }
+        for name in runs:
+            os.makedirs(os.path.join(self.download_root, name))
+            with open(os.path.join(self.download_root, name, "export.zip"), "wb") as f:
+                f.write(b"0" * 1000)
+        hits = {"popular": (now - timedelta(hours=1)).timestamp()}
+
+        evicted = cleanup.evictions(sorted(runs), runs, now, 1500, hits)
+        self.assertEqual([os.path.basename(p) for _, p in evicted], ["superseded", "idle"])
+        evicted = cleanup.evictions(sorted(runs), runs, now, 10 ** 6, hits)
+        self.assertEqual(
+            [os.path.basename(p) for _, p in evicted], ["superseded", "idle", "popular"]
+        )
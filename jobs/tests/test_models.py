@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import logging
+from datetime import datetime, timezone
 from unittest import skip
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import GEOSGeometry, Polygon
@@ -35,6 +37,58 @@ class TestJob(TestCase):
         self.assertIsNotNone(job.created_at)
         self.assertIsNotNone(job.updated_at)
 
+    def test_envelope_search(self):
+        self.fixture['the_geom'] = GEOSGeometry(
+            'POLYGON((-10.8 6.32,-10.79 6.33,-10.78 6.32,-10.8 6.32))', srid=4326)
+        job = Job(**self.fixture)
+        job.save()
+        self.assertEqual(job.envelope.extent, (-10.8, 6.32, -10.78, 6.33))
+        inside = Polygon.from_bbox((-11, 6, -10, 7))
+        inside.srid = 4326
+        across = Polygon.from_bbox((-10.79, 6, -10, 7))
+        across.srid = 4326
+        self.assertTrue(Job.objects.filter(envelope__within=inside).exists())
+        self.assertFalse(Job.objects.filter(envelope__within=across).exists())
+
+    def test_area(self):
+        job = Job(**self.fixture)
+        job.save()
+        # about 243m by 232m
+        self.assertAlmostEqual(job.area, 0.0564, places=3)
+        self.assertEqual(Job.objects.filter(area__lt=1).count(), 1)
+
+    def test_geometry_derived_once(self):
+        job = Job(**self.fixture)
+        job.save()
+        with patch('jobs.models.simplify_geom') as simplify:
+            job.pinned = True
+            job.save()
+            Job.objects.get(pk=job.pk).save()
+            self.assertFalse(simplify.called)
+            job.buffer_aoi = True
+            job.save()
+            self.assertTrue(simplify.called)
+
+    def test_clone_reuses_geometry(self):
+        job = Job(**self.fixture)
+        job.save()
+        self.fixture['the_geom'] = GEOSGeometry(job.the_geom.json, srid=4326)
+        with patch('jobs.models.simplify_geom') as simplify:
+            clone = Job(**self.fixture)
+            clone.save()
+            self.assertFalse(simplify.called)
+        self.assertEqual(clone.geom_hash, job.geom_hash)
+        self.assertEqual(clone.simplified_geom, job.simplified_geom)
+        self.assertEqual(clone.area, job.area)
+
+    @patch('jobs.models.country_code', return_value='LR')
+    def test_country(self, country_code):
+        job = Job(**self.fixture)
+        job.save()
+        self.assertEqual(Job.objects.get(pk=job.pk).country, 'LR')
+        job.save()
+        self.assertEqual(country_code.call_count, 1)
+
     def test_missing_fields(self):
         job = Job(**self.fixture)
         job.full_clean()
@@ -105,6 +159,17 @@ class TestHDXExportRegion(TestCase):
         region.save()
         self.assertIsNotNone(region.id)
 
+    def test_region_sets_job_kind(self):
+        region = HDXExportRegion.objects.create(**self.fixture)
+        self.assertEqual(Job.objects.get(id=self.job.id).kind, 'hdx')
+        region.delete()
+        self.assertEqual(Job.objects.get(id=self.job.id).kind, 'plain')
+
+    def test_region_queryset_delete_resets_job_kind(self):
+        HDXExportRegion.objects.create(**self.fixture)
+        HDXExportRegion.objects.filter(job=self.job).delete()
+        self.assertEqual(Job.objects.get(id=self.job.id).kind, 'plain')
+
     def test_region_validates_job_name(self):
         self.job_fixture['name'] = 'InvalidPrefixWithCaps'
         another_job = Job(**self.job_fixture)
@@ -113,3 +178,47 @@ class TestHDXExportRegion(TestCase):
         with self.assertRaises(ValidationError) as e:
             region.full_clean()
         self.assertTrue('dataset_prefix' in e.exception.message_dict)
+
+
+class TestRegionSchedule(TestCase):
+    def next_run(self, period, hour, now):
+        region = HDXExportRegion(schedule_period=period, schedule_hour=hour)
+        return region.next_run_after(now)
+
+    def test_next_run_after(self):
+        now = datetime(2024, 3, 5, 10, 30, tzinfo=timezone.utc)  # a Tuesday
+        self.assertEqual(self.next_run('6hrs', 3, now), datetime(2024, 3, 5, 15, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('6hrs', 4, now), datetime(2024, 3, 5, 16, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('daily', 12, now), datetime(2024, 3, 5, 12, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('daily', 9, now), datetime(2024, 3, 6, 9, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('weekly', 0, now), datetime(2024, 3, 10, 0, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('monthly', 0, now), datetime(2024, 4, 1, 0, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('quarterly', 0, now), datetime(2024, 4, 1, 0, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('semiyearly', 0, now), datetime(2024, 7, 1, 0, tzinfo=timezone.utc))
+        self.assertEqual(self.next_run('yearly', 0, now), datetime(2025, 1, 1, 0, tzinfo=timezone.utc))
+        self.assertIsNone(self.next_run('disabled', 0, now))
+
+    def test_next_run_is_stored_on_save(self):
+        user = User.objects.create(username='demo', email='demo@demo.com', password='demo')
+        job = Job.objects.create(
+            name='test_region',
+            user=user,
+            the_geom=Polygon.from_bbox((-10.80029,6.3254236,-10.79809,6.32752)),
+            export_formats=['shp'],
+            feature_selection=FeatureSelection.example('simple'),
+        )
+        region = HDXExportRegion.objects.create(job=job, schedule_period='daily', schedule_hour=0)
+        self.assertIsNotNone(region.next_run_at)
+        self.assertGreater(region.next_run_at, datetime.now(timezone.utc))
+        self.assertEqual(region.next_run, region.next_run_at)
+
+        # other edits keep the stored run, a schedule change recomputes it
+        next_run_at = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        HDXExportRegion.objects.filter(pk=region.pk).update(next_run_at=next_run_at)
+        region = HDXExportRegion.objects.get(pk=region.pk)
+        region.extra_notes = 'notes'
+        region.save()
+        self.assertEqual(region.next_run_at, next_run_at)
+        region.schedule_hour = 6
+        region.save()
+        self.assertLess(region.next_run_at, next_run_at)
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+from jobs import secondary_pipeline
+
+
+class PlainRequestHandler(SimpleHTTPRequestHandler):
+    """Serves a directory without Range support."""
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Stand-in for planet.openstreetmap.org: serves a directory,
+    honouring single "Range: bytes=start-[end]" requests."""
+
+    def __init__(self, *args, requested=None, redirects=None, **kwargs):
+        self.requested = requested
+        self.redirects = redirects or {}
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        if self.path in self.redirects:
+            self.send_response(302)
+            self.send_header("Location", self.redirects[self.path])
+            self.end_headers()
+            return None
+        path = self.translate_path(self.path)
+        if self.requested is not None and "Range" in self.headers:
+            self.requested.append(self.headers["Range"])
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        length = os.path.getsize(path)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else length - 1
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, length))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        return RangeFile(f, end - start + 1)
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeFile(object):
+    def __init__(self, f, remaining):
+        self.f = f
+        self.remaining = remaining
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class FakeReplication(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def get_diff_url(self, seq):
+        return "{0}/{1}.osc.gz".format(self.base_url, seq)
+
+
+class TestDiffDownload(unittest.TestCase):
+    def setUp(self):
+        self.served = tempfile.mkdtemp()
+        self.workdir = tempfile.mkdtemp()
+        handler = partial(RangeRequestHandler, directory=self.served)
+        self.httpd = HTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base_url = "http://127.0.0.1:{0}".format(self.httpd.server_port)
+        for seq in range(10, 16):
+            with open(os.path.join(self.served, "{0}.osc.gz".format(seq)), "wb") as f:
+                f.write(os.urandom(1000 + seq))
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.served)
+        shutil.rmtree(self.workdir)
+
+    def assertSameFile(self, a, b):
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            self.assertEqual(fa.read(), fb.read())
+
+    def test_fetch_resumes_partial_file(self):
+        source = os.path.join(self.served, "10.osc.gz")
+        target = os.path.join(self.workdir, "10.osc.gz")
+        with open(source, "rb") as f:
+            partial_data = f.read(300)
+        with open(target, "wb") as f:
+            f.write(partial_data)
+        secondary_pipeline.fetch(self.base_url + "/10.osc.gz", target)
+        self.assertSameFile(source, target)
+
+    def test_download_diffs_records_state(self):
+        replication = FakeReplication(self.base_url)
+        os.remove(os.path.join(self.served, "14.osc.gz"))
+        with self.assertRaises(IOError):
+            secondary_pipeline.download_diffs(replication, 10, 15, self.workdir)
+        state = secondary_pipeline.read_state(os.path.join(self.workdir, "state.json"))
+        self.assertEqual(state["done"], [10, 11, 12, 13, 15])
+
+        with open(os.path.join(self.served, "14.osc.gz"), "wb") as f:
+            f.write(os.urandom(1014))
+        paths = secondary_pipeline.download_diffs(replication, 10, 15, self.workdir)
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ["{0}.osc.gz".format(seq) for seq in range(10, 16)])
+        for path in paths:
+            self.assertSameFile(os.path.join(self.served, os.path.basename(path)), path)
+
+
+class TestPlanetDownload(unittest.TestCase):
+    def setUp(self):
+        self.served = tempfile.mkdtemp()
+        self.workdir = tempfile.mkdtemp()
+        self.requested = []
+        self.redirects = {}
+        handler = partial(
+            RangeRequestHandler,
+            directory=self.served,
+            requested=self.requested,
+            redirects=self.redirects,
+        )
+        self.httpd = HTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/planet-latest.osm.pbf".format(self.httpd.server_port)
+        self.data = os.urandom(100003)
+        with open(os.path.join(self.served, "planet-latest.osm.pbf"), "wb") as f:
+            f.write(self.data)
+        self.write_md5(hashlib.md5(self.data).hexdigest())
+        self.planet = os.path.join(self.workdir, "planet.osm.pbf")
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.served)
+        shutil.rmtree(self.workdir)
+
+    def write_md5(self, digest):
+        with open(os.path.join(self.served, "planet-latest.osm.pbf.md5"), "w") as f:
+            f.write("{0}  planet-240101.osm.pbf\n".format(digest))
+
+    def read_planet(self):
+        with open(self.planet, "rb") as f:
+            return f.read()
+
+    def test_download_in_parts(self):
+        secondary_pipeline.download_planet(self.url, self.planet, parts=4)
+        self.assertEqual(self.read_planet(), self.data)
+        self.assertEqual(os.listdir(self.workdir), ["planet.osm.pbf"])
+
+    def test_resumes_interrupted_download(self):
+        # simulate an interrupted run: metadata and a preallocated file
+        # where the first 100 bytes of the second range were written
+        size = -(-len(self.data) // 4)
+        secondary_pipeline.write_state(self.planet + ".parts.json", {
+            "md5": hashlib.md5(self.data).hexdigest(),
+            "length": len(self.data),
+            "parts": 4,
+            "done": [0, 100, 0, 0],
+        })
+        with open(self.planet + ".download", "wb") as f:
+            f.write(b"\0" * len(self.data))
+            f.seek(size)
+            f.write(self.data[size:size + 100])
+        secondary_pipeline.download_planet(self.url, self.planet, parts=4)
+        self.assertEqual(self.read_planet(), self.data)
+        self.assertIn("bytes={0}-{1}".format(size + 100, 2 * size - 1), self.requested)
+
+    def test_download_without_range_support(self):
+        handler = partial(PlainRequestHandler, directory=self.served)
+        httpd = HTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            url = "http://127.0.0.1:{0}/planet-latest.osm.pbf".format(httpd.server_port)
+            secondary_pipeline.download_planet(url, self.planet, parts=4)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertEqual(self.read_planet(), self.data)
+        self.assertEqual(os.listdir(self.workdir), ["planet.osm.pbf"])
+
+    def test_redirect_target_changes(self):
+        # the alias moves to a new dated planet: the md5 must be the one of
+        # the file the ranges are read from, not the alias's stale one
+        self.write_md5("0" * 32)
+        with open(os.path.join(self.served, "planet-240108.osm.pbf"), "wb") as f:
+            f.write(self.data)
+        with open(os.path.join(self.served, "planet-240108.osm.pbf.md5"), "w") as f:
+            f.write("{0}  planet-240108.osm.pbf\n".format(hashlib.md5(self.data).hexdigest()))
+        self.redirects["/planet-latest.osm.pbf"] = "/planet-240108.osm.pbf"
+        secondary_pipeline.download_planet(self.url, self.planet, parts=4)
+        self.assertEqual(self.read_planet(), self.data)
+
+    def test_md5_mismatch(self):
+        self.write_md5("0" * 32)
+        with self.assertRaises(IOError):
+            secondary_pipeline.download_planet(self.url, self.planet, parts=4)
+        self.assertFalse(os.path.exists(self.planet))
+
+
+class TestChangeIndex(unittest.TestCase):
+    def setUp(self):
+        self.changes_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.changes_dir)
+
+    def read_index(self):
+        return secondary_pipeline.read_state(os.path.join(self.changes_dir, "index.json"))
+
+    def test_updates_are_applied_and_pruned(self):
+        now = secondary_pipeline.datetime(2024, 3, 1, tzinfo=secondary_pipeline.timezone.utc)
+        old = {"first": 1, "last": 1, "start": "", "end": ""}
+        secondary_pipeline.write_changes(self.changes_dir, old, {(1, 2)}, now=now)
+        secondary_pipeline.mark_applied(self.changes_dir, 1, now=now)
+        self.assertIsNotNone(self.read_index()["updates"][0]["applied_at"])
+
+        later = now + secondary_pipeline.CHANGES_RETENTION + secondary_pipeline.timedelta(days=1)
+        entry = {"first": 2, "last": 5, "start": "", "end": ""}
+        secondary_pipeline.write_changes(self.changes_dir, entry, {(3, 4), (-1, 0)}, now=later)
+        updates = self.read_index()["updates"]
+        self.assertEqual(
+            [(u["first"], u["last"], u["applied_at"]) for u in updates], [(2, 5, None)]
+        )
+        self.assertEqual(sorted(os.listdir(self.changes_dir)), ["2-5.json", "index.json"])
+        state = secondary_pipeline.read_state(os.path.join(self.changes_dir, "2-5.json"))
+        cells = state["cells"]
+        self.assertEqual(cells, [[-1, 0], [3, 4]])
+
+
+PLANET = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+{0}
+</osm>
+"""
+
+NODES = """
+<node id="1" version="1" lat="20.05" lon="10.05"/>
+<node id="2" version="1" lat="20.05" lon="10.15"/>
+"""
+
+
+@unittest.skipUnless(shutil.which("osmium"), "needs osmium-tool")
+class TestChangeCells(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, name, content):
+        path = os.path.join(self.workdir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_created_way_of_existing_nodes(self):
+        moved = '<node id="3" version="{0}" lat="-30.05" lon="{1}"/>'
+        planet = self.write("planet.osm", PLANET.format(NODES + moved.format(1, "-50.05")))
+        updated = self.write("updated.osm", PLANET.format(
+            NODES
+            + moved.format(2, "-50.25")
+            + '<way id="10" version="1"><nd ref="1"/><nd ref="2"/></way>'
+        ))
+        merged = self.write("merged.osc", """<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+<create><way id="10" version="1"><nd ref="1"/><nd ref="2"/></way></create>
+<modify>{0}</modify>
+</osmChange>
+""".format(moved.format(2, "-50.25")))
+        cells = secondary_pipeline.change_cells(self.workdir, planet, updated, merged)
+        # the nodes of the new way, and the old and new location of the moved node
+        self.assertEqual(cells, {(100, 200), (101, 200), (-501, -301), (-503, -301)})
+        self.assertEqual(
+            sorted(os.listdir(self.workdir)), ["merged.osc", "planet.osm", "updated.osm"]
+        )
+
+
+class TestShardsStale(unittest.TestCase):
+    def test_extents_and_sequence(self):
+        shards = {"africa": (-27.0, -47.0, 64.0, 38.0), "LR": (-11.6, 4.3, -7.3, 8.6)}
+        index = {"sequence": 5, "locations_on_ways": False, "shards": [
+            {"name": name, "path": "{0}.osm.pbf".format(name), "bbox": list(bbox)}
+            for name, bbox in shards.items()
+        ]}
+        self.assertFalse(secondary_pipeline.shards_stale(index, shards, 5, False))
+        self.assertTrue(secondary_pipeline.shards_stale(index, shards, 6, False))
+        self.assertTrue(secondary_pipeline.shards_stale(index, shards, 5, True))
+        moved = dict(shards, LR=(-11.5, 4.3, -7.3, 8.6))
+        self.assertTrue(secondary_pipeline.shards_stale(index, moved, 5, False))
+        renamed = {"africa": shards["africa"], "liberia": shards["LR"]}
+        self.assertTrue(secondary_pipeline.shards_stale(index, renamed, 5, False))
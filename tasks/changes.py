@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Tells whether OSM data in an AOI changed, from the change index kept by
+jobs/secondary_pipeline.py."""
+import json
+import math
+import os
+from datetime import datetime
+
+from django.contrib.gis.geos import Polygon
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+class ChangeIndex(object):
+    """
+    The grid cells each recorded planet update touched. The cells of an
+    update are only read when a region needs them.
+    """
+
+    def __init__(self, index_path):
+        self.directory = os.path.dirname(index_path)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        self.cell_size = index.get("cell_size")
+        self.updates = sorted(
+            [
+                dict(
+                    update,
+                    start=parse_time(update["start"]),
+                    end=parse_time(update["end"]),
+                    applied_at=parse_time(update["applied_at"]),
+                )
+                for update in index.get("updates", [])
+            ],
+            key=lambda update: update["first"],
+        )
+        self._cells = {}
+
+    @property
+    def applied_at(self):
+        """When the latest recorded update was applied to the planet, or None."""
+        return self.updates[-1]["applied_at"] if self.updates else None
+
+    def cells(self, update):
+        if update["path"] not in self._cells:
+            with open(os.path.join(self.directory, update["path"])) as f:
+                self._cells[update["path"]] = {tuple(c) for c in json.load(f)["cells"]}
+        return self._cells[update["path"]]
+
+    def touches(self, cells, geom):
+        size = self.cell_size
+        minx, miny, maxx, maxy = geom.extent
+        x0, y0 = math.floor(minx / size), math.floor(miny / size)
+        x1, y1 = math.floor(maxx / size), math.floor(maxy / size)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(cells):
+            candidates = [
+                (x, y)
+                for x in range(x0, x1 + 1)
+                for y in range(y0, y1 + 1)
+                if (x, y) in cells
+            ]
+        else:
+            candidates = [c for c in cells if x0 <= c[0] <= x1 and y0 <= c[1] <= y1]
+        prepared = geom.prepared
+        return any(
+            prepared.intersects(
+                Polygon.from_bbox((x * size, y * size, (x + 1) * size, (y + 1) * size))
+            )
+            for x, y in candidates
+        )
+
+    def changed_since(self, geom, since):
+        """
+        Whether OSM data inside geom may have changed after a run that
+        started at `since`. Only False when the index holds every planet
+        update the run did not see, and none of them touched geom.
+        """
+
+        def unseen(update):
+            return (
+                update["applied_at"] is None
+                or update["applied_at"] > since
+                or update["end"] > since
+            )
+
+        # the oldest update must predate the run, or later ones may be pruned
+        if not self.updates or unseen(self.updates[0]):
+            return True
+        for previous, update in zip(self.updates, self.updates[1:]):
+            if update["first"] > previous["last"] + 1:
+                return True
+        try:
+            return any(
+                self.touches(self.cells(update), geom)
+                for update in self.updates
+                if unseen(update)
+            )
+        except (IOError, ValueError, KeyError):
+            return True
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Download hits per run, counted from the access log nginx writes for
+/downloads/ (see ops/packer/nginx.conf) and kept in Redis.
+"""
+import os
+import re
+
+from django.conf import settings
+
+from utils.redis_client import get_client
+
+COUNT_KEY = "download_hits:count"
+LAST_KEY = "download_hits:last"
+OFFSET_KEY = "download_hits:offset"
+
+# lines are "$msec $status $uri"
+LINE = re.compile(r"^(\d+(?:\.\d+)?) (\d{3}) /downloads/([0-9a-f-]{36})/")
+
+
+def parse_hits(lines):
+    """(run uid, timestamp) of every successful download in lines."""
+    for line in lines:
+        match = LINE.match(line)
+        if match and match.group(2) in ("200", "206"):
+            yield match.group(3), float(match.group(1))
+
+
+def read_from(path, offset):
+    with open(path) as f:
+        f.seek(offset)
+        lines = f.readlines()
+        return lines, f.tell()
+
+
+def record_hits(log_path=None, client=None):
+    """
+    Count the hits logged since the last call. A rotated log is detected by
+    its inode and read to its end in log_path + ".1" before the new one.
+    """
+    log_path = log_path or settings.DOWNLOAD_ACCESS_LOG
+    client = client or get_client()
+    if not log_path or not os.path.isfile(log_path):
+        return 0
+
+    inode = os.stat(log_path).st_ino
+    state = client.hgetall(OFFSET_KEY)
+    last_inode = int(state.get(b"inode", 0))
+    offset = int(state.get(b"offset", 0))
+    lines = []
+    if last_inode != inode:
+        rotated = log_path + ".1"
+        if last_inode and os.path.isfile(rotated) and os.stat(rotated).st_ino == last_inode:
+            lines, _ = read_from(rotated, offset)
+        offset = 0
+    elif os.path.getsize(log_path) < offset:  # truncated
+        offset = 0
+    new_lines, offset = read_from(log_path, offset)
+    lines += new_lines
+
+    last = {}
+    count = {}
+    for uid, timestamp in parse_hits(lines):
+        count[uid] = count.get(uid, 0) + 1
+        last[uid] = max(timestamp, last.get(uid, 0))
+    pipe = client.pipeline()
+    for uid, n in count.items():
+        pipe.hincrby(COUNT_KEY, uid, n)
+    if last:
+        pipe.hset(LAST_KEY, mapping=last)
+    pipe.hset(OFFSET_KEY, mapping={"inode": inode, "offset": offset})
+    pipe.execute()
+    return sum(count.values())
+
+
+def last_hits(client=None):
+    """Timestamp of the latest download of each run uid."""
+    client = client or get_client()
+    return {uid.decode(): float(ts) for uid, ts in client.hgetall(LAST_KEY).items()}
+
+
+def forget(uids, client=None):
+    """Drop the counters of removed runs."""
+    uids = list(uids)
+    if uids:
+        client = client or get_client()
+        client.hdel(COUNT_KEY, *uids)
+        client.hdel(LAST_KEY, *uids)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+How current the upstream OSM data sources are. The poll_upstreams command
+fetches them periodically into Redis, where endpoints read them instead of
+calling the upstreams: requests never wait on Overpass or the Raw Data API.
+"""
+import json
+import logging
+import time
+
+import dateutil.parser
+import redis
+import requests
+from django.conf import settings
+
+from utils.redis_client import get_client
+
+LOG = logging.getLogger(__name__)
+
+KEY = "upstream:{0}"
+# a value not refreshed for this long is still served, and logged as stale
+MAX_AGE = 600
+TIMEOUT = 10
+
+
+def check_timestamp(text):
+    # Overpass sometimes answers 200 with an empty body
+    dateutil.parser.parse(text)
+
+
+def check_status(text):
+    dateutil.parser.parse(json.loads(text)["lastUpdated"])
+
+
+def sources():
+    """name: (URL, check raising ValueError or KeyError on a bad body)."""
+    return {
+        "overpass_timestamp": ("{}timestamp".format(settings.OVERPASS_API_URL), check_timestamp),
+        "overpass_status": ("{}status".format(settings.OVERPASS_API_URL), None),
+        "rawdata_status": ("{}v1/status/".format(settings.RAW_DATA_API_URL), check_status),
+    }
+
+
+def fetch(name):
+    url, check = sources()[name]
+    r = requests.get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    if check:
+        check(r.text)
+    return r.text
+
+
+def store(name, text, client):
+    client.set(KEY.format(name), json.dumps({"text": text, "fetched_at": time.time()}))
+
+
+def poll(client=None):
+    """
+    Fetch every source. Those that fail keep their last good value.
+    Returns the errors by source name.
+    """
+    client = client or get_client()
+    errors = {}
+    for name in sources():
+        try:
+            store(name, fetch(name), client)
+        except (requests.RequestException, ValueError, KeyError) as ex:
+            errors[name] = ex
+    return errors
+
+
+def get(name, client=None):
+    """
+    The last polled body of a source, however old, or None when it has never
+    been polled or Redis is unavailable.
+    """
+    client = client or get_client()
+    try:
+        cached = client.get(KEY.format(name))
+    except redis.RedisError as ex:
+        LOG.warning("Upstream freshness cache unavailable: {0}".format(ex))
+        return None
+    if not cached:
+        return None
+    value = json.loads(cached)
+    age = time.time() - value["fetched_at"]
+    if age > MAX_AGE:
+        LOG.warning("{0} was last polled {1:.0f}s ago".format(name, age))
+    return value["text"]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportrun',
+            name='total_bytes',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0002_exportrun_total_bytes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exporttask',
+            name='files',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
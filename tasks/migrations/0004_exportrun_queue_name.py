@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0003_exporttask_files'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportrun',
+            name='queue_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=20),
+        ),
+    ]
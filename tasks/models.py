@@ -8,7 +8,7 @@ from hurry.filesize import size
 
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField
 from jobs.models import Job, HDXExportRegion, SavedFeatureSelection, PartnerExportRegion
@@ -91,6 +91,10 @@ class ExportRun(models.Model):
     status = models.CharField(blank=True, max_length=20, db_index=True, default="")
     started_at = models.DateTimeField(null=True, editable=False)
     finished_at = models.DateTimeField(editable=False, null=True)
+    # sum of the filesize_bytes of the run's tasks, kept by update_total_bytes
+    total_bytes = models.BigIntegerField(default=0, db_index=True, editable=False)
+    # the dramatiq queue the run was sent to
+    queue_name = models.CharField(max_length=20, blank=True, default="", editable=False)
 
     class Meta:
         db_table = "export_runs"
@@ -99,6 +103,23 @@ class ExportRun(models.Model):
     def __str__(self):
         return "{0}".format(self.uid)
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.update_job()
+
+    def update_job(self):
+        """Copy this run onto the last run fields of its job, if it is the newest."""
+        job = Job.objects.select_for_update().only("id").get(id=self.job_id)
+        if ExportRun.objects.filter(job_id=job.id, created_at__gt=self.created_at).exists():
+            return
+        fields = {"last_run": self, "last_run_status": self.status}
+        if self.duration is not None:
+            fields["last_run_duration"] = self.duration
+        if self.finished_at and self.total_bytes:
+            fields["last_run_size"] = self.total_bytes
+        Job.objects.filter(id=job.id).update(**fields)
+
     @property
     def export_formats(self):
         return self.job.export_formats
@@ -113,9 +134,7 @@ class ExportRun(models.Model):
 
     @property
     def is_hdx(self):
-        if HDXExportRegion.objects.filter(job_id=self.job.id).exists():
-            return True
-        return False
+        return self.job.kind == "hdx"
 
     @property
     def duration(self):
@@ -140,9 +159,15 @@ class ExportRun(models.Model):
             self.started_at or self.created_at
         )
 
+    def update_total_bytes(self):
+        self.total_bytes = (
+            self.tasks.aggregate(total=models.Sum("filesize_bytes"))["total"] or 0
+        )
+        ExportRun.objects.filter(id=self.id).update(total_bytes=self.total_bytes)
+
     @property
     def size(self):
-        return sum(map(lambda task: task.filesize_bytes or 0, self.tasks.all()))
+        return self.total_bytes
 
     @property
     def run_size(self):
@@ -166,6 +191,8 @@ class ExportTask(models.Model):
     finished_at = models.DateTimeField(editable=False, null=True)
     filesize_bytes = models.BigIntegerField(null=True)
     filenames = ArrayField(models.TextField(null=True), default=list)
+    # one download_urls entry per file, written when the task finishes
+    files = models.JSONField(default=list, blank=True)
 
     class Meta:
         db_table = "export_tasks"
@@ -201,22 +228,17 @@ class ExportTask(models.Model):
 
     @property
     def download_urls(self):
+        if self.files:
+            return self.files
+
+        # tasks finished before files was stored
         def fdownload(fname):
             valid = validators.url(fname)
             if valid == True:
                 download_url = fname
                 absolute_download_url = download_url
-                try:
-                    value = download_url.split("/")
-                    name = value[-1]
-                    split_name = name.split("_uid_")
-                    file_name = split_name[0]
-                    download_name = (
-                        f"{file_name}.zip" if ".zip" not in file_name else file_name
-                    )  # getting human redable name
-                    fname = download_name
-                except:
-                    fname = f"""{self.run.job.name}_{self.name}.zip"""
+                name = download_url.split("/")[-1]
+                fname = raw_data_filename(download_url)
                 try:
                     config = configparser.ConfigParser()
                     config.read(
@@ -253,6 +275,40 @@ class ExportTask(models.Model):
         return map(fdownload, self.filenames)
 
 
+def raw_data_filename(download_url):
+    """Human readable name of a Raw Data API download."""
+    file_name = download_url.split("/")[-1].split("_uid_")[0]
+    return f"{file_name}.zip" if ".zip" not in file_name else file_name
+
+
+def raw_data_file(item):
+    """download_urls entry of a file stored by the Raw Data API."""
+    download_url = item["download_url"]
+    return {
+        "filename": raw_data_filename(download_url),
+        "filesize_bytes": int(item.get("zip_file_size_bytes") or 0),
+        "download_url": download_url,
+        "absolute_download_url": download_url,
+        "checksum": item.get("md5"),
+    }
+
+
+def local_file(run_uid, path):
+    """
+    download_urls entry of a file in the run's download directory. Its
+    checksum is left out: hashing every output would reread it at finish time.
+    """
+    fname = os.path.basename(path)
+    download_url = os.path.join(settings.EXPORT_MEDIA_ROOT, str(run_uid), fname)
+    return {
+        "filename": fname,
+        "filesize_bytes": os.path.getsize(path),
+        "download_url": download_url,
+        "absolute_download_url": settings.HOSTNAME + download_url,
+        "checksum": None,
+    }
+
+
 class ExportRunAdmin(admin.ModelAdmin, ExportCsvMixin):
     def start(self, request, queryset):
         from tasks.task_runners import run_task_async_ondemand
@@ -260,6 +316,7 @@ class ExportRunAdmin(admin.ModelAdmin, ExportCsvMixin):
         for run in queryset:
             run_task_async_ondemand.send(str(run.uid))
 
+    list_select_related = ("job", "user")
     list_display = [
         "uid",
         "job_ui_link",
@@ -333,6 +390,7 @@ class JobAdmin(GeoModelAdmin, ExportCsvMixin):
         return obj.simplified_geom.json
 
     search_fields = ["uid", "name", "user__username"]
+    list_select_related = ("user", "last_run")
     list_display = [
         "uid",
         "name",
@@ -374,6 +432,7 @@ class HDXExportRegionAdmin(admin.ModelAdmin, ExportCsvMixin):
         "locations",
         "created_by",
     ]
+    list_select_related = ("job", "job__last_run")
     list_filter = ("schedule_period", "is_private", "schedule_hour")
     raw_id_fields = ("job",)
     search_fields = ["job__name", "job__description", "job__uid"]
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Picks the planet file an OsmiumTool extract reads from."""
+import json
+import logging
+import os
+import subprocess
+from functools import lru_cache
+
+import osmium
+import shapely.geometry
+from django.conf import settings
+from osm_export_tool.sources import OsmiumTool
+
+LOG = logging.getLogger(__name__)
+
+
+def read_shards_index(index_path):
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def covers(bbox, bounds):
+    return (
+        bbox[0] <= bounds[0]
+        and bbox[1] <= bounds[1]
+        and bbox[2] >= bounds[2]
+        and bbox[3] >= bounds[3]
+    )
+
+
+def planet_file_for(geom):
+    """
+    Return the smallest regional shard whose bounding box covers geom,
+    or settings.PLANET_FILE if there is no such shard or the shards were
+    cut from an older planet than the current one.
+
+    Args:
+        geom: the clipping geometry (anything with shapely-style bounds).
+    """
+    index_path = settings.PLANET_SHARDS_INDEX
+    if not index_path:
+        return settings.PLANET_FILE
+
+    index = read_shards_index(index_path)
+    sequence = planet_sequence(settings.PLANET_FILE)
+    if sequence is not None and (index.get("sequence") or 0) < sequence:
+        LOG.warning(
+            "Planet shards at sequence {0} are behind the planet at {1}".format(
+                index.get("sequence"), sequence
+            )
+        )
+        return settings.PLANET_FILE
+
+    index_dir = os.path.dirname(index_path)
+    candidates = []
+    for shard in index.get("shards", []):
+        path = os.path.join(index_dir, shard["path"])
+        if covers(shard["bbox"], geom.bounds) and os.path.isfile(path):
+            minx, miny, maxx, maxy = shard["bbox"]
+            candidates.append(((maxx - minx) * (maxy - miny), path))
+
+    if not candidates:
+        return settings.PLANET_FILE
+
+    path = min(candidates)[1]
+    LOG.debug("Using planet shard {0}".format(path))
+    return path
+
+
+@lru_cache(maxsize=32)
+def _read_header(path, mtime):
+    """(whether it has locations on ways, replication sequence or None) of a PBF."""
+    reader = osmium.io.Reader(path, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        header = reader.header()
+    finally:
+        reader.close()
+    features = [header.get("pbf_optional_feature_{0}".format(i)) for i in range(4)]
+    sequence = header.get("osmosis_replication_sequence_number")
+    return "LocationsOnWays" in features, int(sequence) if sequence else None
+
+
+def has_locations_on_ways(path):
+    """True if the PBF at path stores node locations on its ways."""
+    try:
+        return _read_header(path, os.path.getmtime(path))[0]
+    except (OSError, RuntimeError):
+        return False
+
+
+def planet_sequence(path):
+    """The replication sequence number of the PBF at path, or None if unknown."""
+    try:
+        return _read_header(path, os.path.getmtime(path))[1]
+    except (OSError, RuntimeError, ValueError):
+        return None
+
+
+class LocationsOnWaysOsmiumTool(OsmiumTool):
+    """
+    OsmiumTool for a source written with locations on ways: the extract
+    and tags-filter output keep them, so the handler can read it
+    without building a node location index.
+    """
+
+    OUTPUT_FORMAT = ["-f", "pbf,locations_on_ways=true"]
+
+    def tags_filter(self, filters, planet_as_source):
+        source_path = self.output_path
+        if planet_as_source is True:
+            source_path = self.source_path
+
+        cmd = [self.osmium_path, "tags-filter", source_path, "-o", self.output_path]
+
+        for f in filters:
+            cmd.insert(3, f)
+
+        if planet_as_source is False:
+            cmd.append("--overwrite")
+
+        subprocess.check_call(cmd + self.OUTPUT_FORMAT)
+
+    def fetch(self):
+        region_json = os.path.join(self.tempdir, "region.json")
+        with open(region_json, "w") as f:
+            f.write(
+                json.dumps(
+                    {"type": "Feature", "geometry": shapely.geometry.mapping(self.geom)}
+                )
+            )
+        subprocess.check_call(
+            [
+                self.osmium_path,
+                "extract",
+                "-p",
+                region_json,
+                self.source_path,
+                "-o",
+                self.output_path,
+                "--overwrite",
+            ]
+            + self.OUTPUT_FORMAT
+        )
+        os.remove(region_json)
+
+
+def apply_handler(handler, source_path, locations=True):
+    """
+    Apply a tabular handler to source_path. Without locations, the ways of
+    the source carry their node locations: areas are assembled by an area
+    manager alone, as SimpleHandler.apply_file builds a node location index
+    whenever the handler has an area callback.
+    """
+    if locations:
+        handler.apply_file(source_path, locations=True, idx="sparse_file_array")
+        return
+
+    areas = osmium.area.AreaManager()
+    reader = osmium.io.Reader(source_path, osmium.osm.osm_entity_bits.RELATION)
+    try:
+        osmium.apply(reader, areas.first_pass_handler())
+    finally:
+        reader.close()
+    reader = osmium.io.Reader(source_path)
+    try:
+        osmium.apply(reader, handler, areas.second_pass_handler(handler))
+    finally:
+        reader.close()
+
+
+def planet_extract(geom, output_path, tempdir, mapping=None, source_path=None):
+    """
+    Build the source for a planet_file export.
+
+    Args:
+        source_path: a PBF already cut for this region by batch_extract,
+            read instead of the planet when given.
+
+    Returns:
+        (source, locations): the OsmiumTool source, and whether apply_handler
+        still needs to build a node location index for its output.
+    """
+    if not (source_path and os.path.isfile(source_path)):
+        source_path = planet_file_for(geom)
+    if has_locations_on_ways(source_path):
+        source = LocationsOnWaysOsmiumTool(
+            "osmium", source_path, geom, output_path, tempdir=tempdir, mapping=mapping
+        )
+        return source, False
+    source = OsmiumTool(
+        "osmium", source_path, geom, output_path, tempdir=tempdir, mapping=mapping
+    )
+    return source, True
+
+
+def batch_extract(regions, output_dir):
+    """
+    Cut a PBF for each region from the planet with a single osmium extract,
+    i.e. one read of the planet (or of the smallest shard covering them all).
+
+    Returns:
+        a dict of job uid to the extracted PBF path.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    extents = [r.simplified_geom.extent for r in regions]
+    source_path = planet_file_for(
+        shapely.geometry.box(
+            min(e[0] for e in extents),
+            min(e[1] for e in extents),
+            max(e[2] for e in extents),
+            max(e[3] for e in extents),
+        )
+    )
+    output_format = "pbf"
+    if has_locations_on_ways(source_path):
+        output_format = "pbf,locations_on_ways=true"
+
+    extracts = {}
+    config = {"directory": output_dir, "extracts": []}
+    for region in regions:
+        job_uid = str(region.job_uid)
+        region_json = os.path.join(output_dir, "{0}.geojson".format(job_uid))
+        with open(region_json, "w") as f:
+            f.write(
+                json.dumps(
+                    {"type": "Feature", "geometry": json.loads(region.simplified_geom.json)}
+                )
+            )
+        config["extracts"].append(
+            {
+                "output": "{0}.osm.pbf".format(job_uid),
+                "output_format": output_format,
+                "polygon": {"file_name": region_json, "file_type": "geojson"},
+            }
+        )
+        extracts[job_uid] = os.path.join(output_dir, "{0}.osm.pbf".format(job_uid))
+
+    config_path = os.path.join(output_dir, "extracts.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+    LOG.debug("Extracting {0} regions from {1}".format(len(regions), source_path))
+    subprocess.check_call(
+        ["osmium", "extract", "--overwrite", "-c", config_path, source_path]
+    )
+    os.remove(config_path)
+    return extracts
+
+
+def remove_batch_extract(path):
+    """Remove a batch_extract output once its run is done with it."""
+    for p in (path, path.replace(".osm.pbf", ".geojson")):
+        if os.path.isfile(p):
+            os.remove(p)
+    try:
+        os.rmdir(os.path.dirname(path))  # only succeeds for the last region
+    except OSError:
+        pass
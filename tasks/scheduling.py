@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Spreads scheduled region runs over the workers of the scheduled queue."""
+import heapq
+from datetime import timedelta
+
+from django.db.models import Avg, F
+from django.utils import timezone
+
+from tasks.models import ExportRun
+
+DEFAULT_DURATION = 60 * 60  # seconds, for jobs without a completed run
+HISTORY = timedelta(days=90)
+
+
+def expected_durations(job_ids):
+    """Mean duration in seconds of each job's completed runs over HISTORY."""
+    rows = (
+        ExportRun.objects.filter(
+            job_id__in=job_ids,
+            status="COMPLETED",
+            started_at__isnull=False,
+            finished_at__isnull=False,
+            created_at__gte=timezone.now() - HISTORY,
+        )
+        .values("job_id")
+        .annotate(duration=Avg(F("finished_at") - F("started_at")))
+    )
+    return {row["job_id"]: row["duration"].total_seconds() for row in rows}
+
+
+def estimate_durations(regions):
+    """
+    Expected run duration in seconds of each region's job. Jobs without a
+    completed run are estimated from their AOI area, at the seconds per
+    square kilometre of the regions that have one.
+    """
+    durations = expected_durations([r.job_id for r in regions])
+    known = [r for r in regions if r.job_id in durations]
+    area = sum(r.job.area or 0 for r in known)
+    rate = sum(durations[r.job_id] for r in known) / area if area else None
+    for region in regions:
+        if region.job_id not in durations:
+            durations[region.job_id] = (
+                rate * region.job.area if rate and region.job.area else DEFAULT_DURATION
+            )
+    return durations
+
+
+def scheduled_backlog():
+    """
+    Expected remaining seconds of every region run that is already
+    queued or running on the scheduled queue.
+    """
+    runs = list(
+        ExportRun.objects.filter(status__in=["SUBMITTED", "RUNNING"], queue_name="scheduled")
+        .only("job_id", "status", "started_at")
+    )
+    durations = expected_durations({run.job_id for run in runs})
+    now = timezone.now()
+    backlog = []
+    for run in runs:
+        remaining = durations.get(run.job_id, DEFAULT_DURATION)
+        if run.status == "RUNNING" and run.started_at:
+            remaining -= (now - run.started_at).total_seconds()
+        backlog.append(max(remaining, 0))
+    return backlog
+
+
+def plan_delays(regions, durations, workers, window, backlog=()):
+    """
+    Give each region a start delay so that about `workers` runs are
+    expected to execute at once: a run is released when the worker slot it
+    was assigned to is expected to free up. A delay never exceeds `window`,
+    nor pushes a run past the start of its next period.
+
+    Args:
+        regions: due regions, in the order they should start.
+        durations: expected run duration in seconds, by job id.
+        workers: concurrency of the scheduled queue.
+        window: longest delay in seconds.
+        backlog: expected remaining seconds of runs already queued.
+
+    Returns:
+        a list of (region, delay in seconds).
+    """
+    slots = [0.0] * max(workers, 1)
+    for remaining in sorted(backlog):
+        free = heapq.heappop(slots)
+        heapq.heappush(slots, free + remaining)
+
+    plan = []
+    for region in regions:
+        duration = durations.get(region.job_id, DEFAULT_DURATION)
+        latest_start = max(0.0, min(window, region.delta.total_seconds() - duration))
+        free = heapq.heappop(slots)
+        plan.append((region, min(free, latest_start)))
+        heapq.heappush(slots, free + duration)
+    return plan
@@ -3,13 +3,13 @@
 
 import logging
 import os
-from os.path import join, exists, basename
+from os.path import join, exists
 import json
 import ast
+import time
 import shutil
 import zipfile
 import traceback
-import configparser
 import django
 from dramatiq.middleware import TimeLimitExceeded
 
@@ -31,7 +31,7 @@ from django.utils import timezone
 from django.utils.text import get_valid_filename
 
 from jobs.models import Job, HDXExportRegion, PartnerExportRegion
-from tasks.models import ExportRun, ExportTask
+from tasks.models import ExportRun, ExportTask, local_file, raw_data_file
 from hdx_exports.hdx_export_set import slugify, sync_region
 
 import osm_export_tool
@@ -39,7 +39,7 @@ import osm_export_tool.tabular as tabular
 import osm_export_tool.nontabular as nontabular
 from osm_export_tool.mapping import Mapping
 from osm_export_tool.geometry import load_geometry
-from osm_export_tool.sources import Overpass, OsmiumTool, Galaxy
+from osm_export_tool.sources import Overpass, Galaxy
 from osm_export_tool.package import create_package, create_posm_bundle
 
 import shapely.geometry
@@ -52,6 +52,7 @@ from .email import (
 )
 
 from .pdc import run_pdc_task
+from .planet import apply_handler, batch_extract, planet_extract, remove_batch_extract
 
 client = Client()
 
@@ -73,7 +74,9 @@ dramatiq.get_broker().add_middleware(abortable)
 
 
 class ExportTaskRunner(object):
-    def run_task(self, job_uid=None, user=None, ondemand=True):  # noqa
+    def run_task(
+        self, job_uid=None, user=None, ondemand=True, source_path=None, delay=None
+    ):  # noqa
         LOG.debug("Running Job with id: {0}".format(job_uid))
         job = Job.objects.get(uid=job_uid)
         if not user:
@@ -88,13 +91,14 @@ class ExportTaskRunner(object):
                 ExportTask.objects.create(run=run, status="PENDING", name=format_name)
                 LOG.debug("Saved task: {0}".format(format_name))
 
-            if HDXExportRegion.objects.filter(job=job).exists():
+            if job.kind == "hdx":
                 ondemand = False  # move hdx jobs to scheduled even though triggered from run now , so that they won't block ondemand queue
             if ondemand:
                 # run_task_remote(run_uid)
                 # db.close_old_connections()
                 send_task = run_task_async_ondemand.send(run_uid)
                 run.worker_message_id = send_task.message_id
+                run.queue_name = run_task_async_ondemand.queue_name
                 run.save()
                 LOG.debug(
                     "Worker message saved with task_message_id:{0} ".format(
@@ -104,8 +108,12 @@ class ExportTaskRunner(object):
             else:
                 # run_task_remote(run_uid)
                 # db.close_old_connections()
-                send_task = run_task_async_scheduled.send(run_uid)
+                send_task = run_task_async_scheduled.send_with_options(
+                    args=(run_uid, source_path),
+                    delay=int(delay * 1000) if delay else None,
+                )
                 run.worker_message_id = send_task.message_id
+                run.queue_name = run_task_async_scheduled.queue_name
                 run.save()
                 LOG.debug(
                     "Worker message saved with task_message_id:{0} ".format(
@@ -140,9 +148,9 @@ def run_task_async_ondemand(run_uid):
 @dramatiq.actor(
     max_retries=0, queue_name="scheduled", time_limit=1000 * 60 * 60 * 12
 )  #  12 hour
-def run_task_async_scheduled(run_uid):
+def run_task_async_scheduled(run_uid, source_path=None):
     try:
-        run_task_remote(run_uid)
+        run_task_remote(run_uid, source_path)
     except TimeLimitExceeded:
         run = ExportRun.objects.get(uid=run_uid)
         client.captureException(extra={"run_uid": run_uid})
@@ -153,8 +161,62 @@ def run_task_async_scheduled(run_uid):
     db.close_old_connections()
 
 
-def run_task_remote(run_uid):
+@dramatiq.actor(
+    max_retries=0, queue_name="scheduled", time_limit=1000 * 60 * 60 * 4
+)  # 4 hour
+def batch_extract_scheduled(batch_dir, planned, planned_at):
+    """
+    Cut the due planet_file regions of a schedule tick from the planet in
+    one pass, then enqueue their runs reading the cut PBFs. If the batch
+    extract fails, the runs are enqueued to extract their own AOI.
+
+    Args:
+        planned: [job uid, start delay in seconds] of each region, in order.
+        planned_at: the time.time() the delays were planned at.
+    """
+    regions = {
+        str(region.job.uid): region
+        for regioncls in (HDXExportRegion, PartnerExportRegion)
+        for region in regioncls.objects.filter(
+            job__uid__in=[job_uid for job_uid, _ in planned]
+        ).select_related("job")
+    }
+    source_paths = {}
+    try:
+        source_paths = batch_extract(list(regions.values()), batch_dir)
+    except (Exception, TimeLimitExceeded) as ex:
+        client.captureException(extra={"batch_dir": batch_dir})
+        LOG.warn("Batch extract failed, runs will extract individually: {0}".format(ex))
+        shutil.rmtree(batch_dir, True)
+
+    elapsed = time.time() - planned_at
+    for job_uid, delay in planned:
+        if job_uid not in regions:
+            continue
+        source_path = source_paths.get(job_uid)
+        run = ExportTaskRunner().run_task(
+            job_uid=job_uid,
+            ondemand=False,
+            source_path=source_path,
+            delay=max(delay - elapsed, 0),
+        )
+        if run is None and source_path:
+            remove_batch_extract(source_path)
+    db.close_old_connections()
+
+
+def update_next_run(job):
+    """Reschedule the region of a job once its run has finished."""
+    regioncls = {"hdx": HDXExportRegion, "partner": PartnerExportRegion}.get(job.kind)
+    if regioncls:
+        for region in regioncls.objects.filter(job_id=job.id):
+            region.update_next_run()
+            region.save(update_fields=["next_run_at"])
+
+
+def run_task_remote(run_uid, source_path=None):
     stage_dir = None
+    run = None
     try:
         run = ExportRun.objects.get(uid=run_uid)
         run.status = "RUNNING"
@@ -167,7 +229,7 @@ def run_task_remote(run_uid):
         if not exists(download_dir):
             os.makedirs(download_dir)
 
-        run_task(run_uid, run, stage_dir, download_dir)
+        run_task(run_uid, run, stage_dir, download_dir, source_path)
 
     except (Job.DoesNotExist, ExportRun.DoesNotExist, ExportTask.DoesNotExist):
         LOG.warn("Job was deleted - exiting.")
@@ -178,16 +240,20 @@ def run_task_remote(run_uid):
         run.finished_at = timezone.now()
         run.save()
 
-        if HDXExportRegion.objects.filter(job_id=run.job_id).exists():
+        if run.job.kind == "hdx":
             send_hdx_error_notification(run, run.job.hdx_export_region_set.first())
         LOG.warn("ExportRun {0} failed: {1}".format(run_uid, ex))
         LOG.warn(traceback.format_exc())
     finally:
         if stage_dir:
             shutil.rmtree(stage_dir)
+        if source_path:
+            remove_batch_extract(source_path)
+        if run is not None:
+            update_next_run(run.job)
 
 
-def run_task(run_uid, run, stage_dir, download_dir):
+def run_task(run_uid, run, stage_dir, download_dir, source_path=None):
     LOG.debug("Running ExportRun with id: {0}".format(run_uid))
     job = run.job
     valid_name = get_valid_filename(job.name)
@@ -214,19 +280,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
             return ast.literal_eval(res_item)
         return res_item
 
-    def write_file_size(response):
-        LOG.debug("Logging response %s", response)
-        if response:
-            for item in response:
-                item = format_response(item)
-                config = configparser.ConfigParser()
-                config["FileInfo"] = {"FileSize": str(item["zip_file_size_bytes"])}
-                size_path = join(
-                    download_dir, f"{item['download_url'].split('/')[-1]}_size.ini"
-                )
-                with open(size_path, "w") as configfile:
-                    config.write(configfile)
-
     def finish_task(name, created_files=None, response_back=None, planet_file=False):
         LOG.debug("Task Finish: {0} for run: {1}".format(name, run_uid))
         task = ExportTask.objects.get(run__uid=run_uid, name=name)
@@ -234,32 +287,22 @@ def run_task(run_uid, run, stage_dir, download_dir):
         task.finished_at = timezone.now()
         # assumes each file only has one part (all are zips or PBFs)
         if response_back:
-            task.filenames = [
-                format_response(item)["download_url"] for item in response_back
-            ]
+            task.files = [raw_data_file(format_response(item)) for item in response_back]
+            task.filenames = [f["download_url"] for f in task.files]
         else:
-            task.filenames = [basename(file.parts[0]) for file in created_files]
+            task.files = [local_file(run_uid, file.parts[0]) for file in created_files]
+            task.filenames = [f["filename"] for f in task.files]
         if planet_file is False:
-            if response_back:
-                total_bytes = 0
-                for item in response_back:
-                    item = format_response(item)
-                    total_bytes += int(
-                        str(item["zip_file_size_bytes"])
-                    )  # getting filesize bytes
-                task.filesize_bytes = total_bytes
-            else:
-                total_bytes = 0
-                for file in created_files:
-                    total_bytes += file.size()
-                task.filesize_bytes = total_bytes
+            task.filesize_bytes = sum(f["filesize_bytes"] for f in task.files)
         task.save()
+        run.update_total_bytes()
 
-    is_hdx_export = HDXExportRegion.objects.filter(job_id=run.job_id).exists()
-    is_partner_export = PartnerExportRegion.objects.filter(job_id=run.job_id).exists()
+    is_hdx_export = run.job.kind == "hdx"
+    is_partner_export = run.job.kind == "partner"
 
     planet_file = False
     polygon_centroid = False
+    locations = True  # build a node location index unless the source has them on ways
     use_only_galaxy = False
     all_feature_filter_json = None
 
@@ -312,7 +355,9 @@ def run_task(run_uid, run, stage_dir, download_dir):
             os.chmod(target, 0o644)
 
             finish_task(
-                "geopackage", [osm_export_tool.File("gpkg", [target], "")], planet_file
+                "geopackage",
+                [osm_export_tool.File("gpkg", [target], "")],
+                planet_file=planet_file,
             )
 
             send_completion_notification(run)
@@ -414,12 +459,11 @@ def run_task(run_uid, run, stage_dir, download_dir):
             h = tabular.Handler(
                 tabular_outputs, mapping, polygon_centroid=polygon_centroid
             )
-            source = OsmiumTool(
-                "osmium",
-                settings.PLANET_FILE,
+            source, locations = planet_extract(
                 geom,
                 join(stage_dir, "extract.osm.pbf"),
-                tempdir=stage_dir,
+                stage_dir,
+                source_path=source_path,
             )
 
         else:
@@ -443,7 +487,7 @@ def run_task(run_uid, run, stage_dir, download_dir):
             LOG.debug("Source start for run: {0}".format(run_uid))
             source_path = source.path()
             LOG.debug("Source end for run: {0}".format(run_uid))
-            h.apply_file(source_path, locations=True, idx="sparse_file_array")
+            apply_handler(h, source_path, locations)
 
         all_zips = []
 
@@ -463,7 +507,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                     "Raw Data API fetch started geojson for run: {0}".format(run_uid)
                 )
                 response_back = geojson.fetch("geojson", is_hdx_export=True)
-                write_file_size(response_back)
                 LOG.debug(
                     "Raw Data API fetch ended for geojson run: {0}".format(run_uid)
                 )
@@ -477,7 +520,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
             try:
                 LOG.debug("Raw Data API fetch started for csv run: {0}".format(run_uid))
                 response_back = csv.fetch("csv", is_hdx_export=True)
-                write_file_size(response_back)
                 LOG.debug("Raw Data API fetch ended for csv run: {0}".format(run_uid))
                 finish_task("csv", response_back=response_back)
                 all_zips += response_back
@@ -495,7 +537,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                         )
                     )
                     response_back = geopackage.fetch("gpkg", is_hdx_export=True)
-                    write_file_size(response_back)
                     LOG.debug(
                         "Raw Data API fetch ended for geopackage run: {0}".format(
                             run_uid
@@ -543,7 +584,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                     )
 
                     response_back = shp.fetch("shp", is_hdx_export=True)
-                    write_file_size(response_back)
                     LOG.debug(
                         "Raw Data API fetch ended  for shp run: {0}".format(run_uid)
                     )
@@ -588,7 +628,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                         "Raw Data API fetch started for kml run: {0}".format(run_uid)
                     )
                     response_back = kml.fetch("kml", is_hdx_export=True)
-                    write_file_size(response_back)
                     LOG.debug(
                         "Raw Data API fetch ended for kml run: {0}".format(run_uid)
                     )
@@ -752,13 +791,12 @@ def run_task(run_uid, run, stage_dir, download_dir):
             h = tabular.Handler(
                 tabular_outputs, mapping, polygon_centroid=polygon_centroid
             )
-            source = OsmiumTool(
-                "osmium",
-                settings.PLANET_FILE,
+            source, locations = planet_extract(
                 geom,
                 join(stage_dir, "extract.osm.pbf"),
-                tempdir=stage_dir,
+                stage_dir,
                 mapping=mapping,
+                source_path=source_path,
             )
         else:
             if use_only_galaxy == False:
@@ -790,7 +828,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = geojson.fetch(
                     "geojson", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
 
                 LOG.debug(
                     "Raw Data API fetch ended for geojson run: {0}".format(run_uid)
@@ -809,7 +846,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = fgb.fetch(
                     "fgb", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
                 LOG.debug("Raw Data API fetch ended for fgb run: {0}".format(run_uid))
                 finish_task("fgb", response_back=response_back)
             except Exception as ex:
@@ -825,7 +861,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = csv.fetch(
                     "csv", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
                 LOG.debug("Raw Data API fetch ended for csv run: {0}".format(run_uid))
                 finish_task("csv", response_back=response_back)
             except Exception as ex:
@@ -841,7 +876,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = sql.fetch(
                     "sql", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
                 LOG.debug("Raw Data API fetch ended for sql run: {0}".format(run_uid))
                 finish_task("sql", response_back=response_back)
             except Exception as ex:
@@ -859,7 +893,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = geopackage.fetch(
                     "gpkg", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
                 LOG.debug(
                     "Raw Data API fetch ended for geopackage run: {0}".format(run_uid)
                 )
@@ -876,7 +909,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = shp.fetch(
                     "shp", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
                 LOG.debug("Raw Data API fetch ended for shp run:  {0}".format(run_uid))
                 finish_task("shp", response_back=response_back)
             except Exception as ex:
@@ -892,7 +924,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 response_back = kml.fetch(
                     "kml", all_feature_filter_json=all_feature_filter_json
                 )
-                write_file_size(response_back)
                 LOG.debug("Raw Data API fetch ended for kml run: {0}".format(run_uid))
                 finish_task("kml", response_back=response_back)
 
@@ -922,7 +953,6 @@ def run_task(run_uid, run, stage_dir, download_dir):
                     min_zoom=job.mbtiles_minzoom,
                     max_zoom=job.mbtiles_maxzoom,
                 )
-                write_file_size(response_back)
                 LOG.debug(
                     "Raw Data API fetch ended for mbtiles run: {0}".format(run_uid)
                 )
@@ -937,7 +967,7 @@ def run_task(run_uid, run, stage_dir, download_dir):
             source_path = source.path()
             LOG.debug("Source end for run: {0}".format(run_uid))
 
-            h.apply_file(source_path, locations=True, idx="sparse_file_array")
+            apply_handler(h, source_path, locations)
 
         if "garmin_img" in export_formats:
             start_task("garmin_img")
@@ -1023,7 +1053,9 @@ def run_task(run_uid, run, stage_dir, download_dir):
                 shutil.move(source_path, target)
                 os.chmod(target, 0o644)
                 finish_task(
-                    "osm_pbf", [osm_export_tool.File("pbf", [target], "")], planet_file
+                    "osm_pbf",
+                    [osm_export_tool.File("pbf", [target], "")],
+                    planet_file=planet_file,
                 )
             except Exception as ex:
                 stop_task("osm_pbf")
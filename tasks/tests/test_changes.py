@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.gis.geos import Polygon
+from django.test import SimpleTestCase
+
+from ..changes import ChangeIndex
+
+
+class TestChangeIndex(SimpleTestCase):
+    def setUp(self):
+        self.changes_dir = tempfile.mkdtemp()
+        self.index = os.path.join(self.changes_dir, "index.json")
+        self.day = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        # Monrovia was edited on the second day only
+        self.write([(1, 1, [[100, 100]]), (2, 2, [[-108, 63]])])
+        self.monrovia = Polygon.from_bbox((-10.80029, 6.3254236, -10.79809, 6.32752))
+
+    def tearDown(self):
+        shutil.rmtree(self.changes_dir)
+
+    def write(self, updates):
+        entries = []
+        for first, last, cells in updates:
+            path = "{0}-{1}.json".format(first, last)
+            with open(os.path.join(self.changes_dir, path), "w") as f:
+                json.dump({"cell_size": 0.1, "cells": cells}, f)
+            end = self.day + timedelta(days=last)
+            entries.append({
+                "first": first,
+                "last": last,
+                "start": (end - timedelta(days=1)).isoformat(),
+                "end": end.isoformat(),
+                "recorded_at": (end + timedelta(hours=3)).isoformat(),
+                "applied_at": (end + timedelta(hours=4)).isoformat(),
+                "path": path,
+            })
+        with open(self.index, "w") as f:
+            json.dump({"cell_size": 0.1, "updates": entries}, f)
+
+    def test_changed_since(self):
+        changes = ChangeIndex(self.index)
+        # runs before the update that touched the AOI was applied saw the old data
+        self.assertTrue(changes.changed_since(self.monrovia, self.day + timedelta(days=1, hours=5)))
+        self.assertFalse(changes.changed_since(self.monrovia, self.day + timedelta(days=2, hours=5)))
+        self.assertFalse(
+            changes.changed_since(Polygon.from_bbox((0, 0, 1, 1)), self.day + timedelta(days=1, hours=5))
+        )
+
+    def test_unknown_history_counts_as_changed(self):
+        changes = ChangeIndex(self.index)
+        # older than every recorded update
+        self.assertTrue(changes.changed_since(self.monrovia, self.day))
+        self.write([(1, 1, []), (3, 3, [])])
+        self.assertTrue(ChangeIndex(self.index).changed_since(self.monrovia, self.day + timedelta(days=1, hours=5)))
+        self.assertTrue(ChangeIndex(os.path.join(self.changes_dir, "missing.json")).changed_since(self.monrovia, self.day))
+
+    def test_applied_at(self):
+        self.assertEqual(ChangeIndex(self.index).applied_at, self.day + timedelta(days=2, hours=4))
+        self.assertIsNone(ChangeIndex(os.path.join(self.changes_dir, "missing.json")).applied_at)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.test import SimpleTestCase
+
+from ..downloads import parse_hits
+
+
+class TestParseHits(SimpleTestCase):
+    def test_parse_hits(self):
+        uid = "8b1e4a42-7bd1-4a0e-9d0e-3c4a6b0c7f11"
+        lines = [
+            "1709251200.123 200 /downloads/{0}/Liberia_buildings_gpkg.zip\n".format(uid),
+            "1709251300.000 206 /downloads/{0}/Liberia_roads_shp.zip\n".format(uid),
+            "1709251400.000 404 /downloads/{0}/missing.zip\n".format(uid),
+            "1709251500.000 200 /downloads/\n",
+        ]
+        self.assertEqual(list(parse_hits(lines)), [(uid, 1709251200.123), (uid, 1709251300.0)])
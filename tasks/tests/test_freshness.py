@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import Mock, patch
+
+import redis
+from django.test import SimpleTestCase, override_settings
+
+from .. import freshness
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+class DownRedis(object):
+    def get(self, key):
+        raise redis.ConnectionError("Connection refused")
+
+    def set(self, key, value, ex=None):
+        raise redis.ConnectionError("Connection refused")
+
+
+def response(text):
+    return Mock(text=text, raise_for_status=Mock())
+
+
+@override_settings(OVERPASS_API_URL="http://overpass/", RAW_DATA_API_URL="http://rawdata/")
+class TestFreshness(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeRedis()
+
+    @patch("tasks.freshness.requests.get")
+    def test_poll_keeps_last_good_value(self, get):
+        bodies = {
+            "http://overpass/timestamp": "2024-03-01T00:00:00Z",
+            "http://overpass/status": "Connected as: 1",
+            "http://rawdata/v1/status/": '{"lastUpdated": "2024-03-01T00:00:00+00:00"}',
+        }
+        get.side_effect = lambda url, timeout: response(bodies[url])
+        self.assertEqual(freshness.poll(self.client), {})
+
+        # an empty timestamp is not stored
+        bodies["http://overpass/timestamp"] = ""
+        errors = freshness.poll(self.client)
+        self.assertEqual(list(errors), ["overpass_timestamp"])
+        self.assertEqual(
+            freshness.get("overpass_timestamp", self.client), "2024-03-01T00:00:00Z"
+        )
+        self.assertEqual(freshness.get("overpass_status", self.client), "Connected as: 1")
+
+    @patch("tasks.freshness.requests.get")
+    def test_get_never_fetches(self, get):
+        self.assertIsNone(freshness.get("overpass_timestamp", self.client))
+        self.assertIsNone(freshness.get("overpass_timestamp", DownRedis()))
+        get.assert_not_called()
+
+    def test_get_serves_stale_value(self):
+        with patch("tasks.freshness.time.time", return_value=1000):
+            freshness.store("overpass_timestamp", "2024-03-01T00:00:00Z", self.client)
+        with patch("tasks.freshness.time.time", return_value=1000 + freshness.MAX_AGE * 10):
+            with self.assertLogs("tasks.freshness", "WARNING"):
+                text = freshness.get("overpass_timestamp", self.client)
+        self.assertEqual(text, "2024-03-01T00:00:00Z")
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 import uuid
 
 from django.conf import settings
@@ -11,7 +14,7 @@ import datetime
 from jobs.models import Job
 from feature_selection.feature_selection import FeatureSelection
 
-from ..models import ExportRun, ExportTask
+from ..models import ExportRun, ExportTask, local_file, raw_data_file
 
 class TestExportRunAndTask(TestCase):
     """
@@ -88,5 +91,70 @@ class TestExportRunAndTask(TestCase):
         self.assertEqual(list(task.download_urls)[0]['download_url'],root+str(run.uid)+'/'+'a_filename')
         self.assertEqual(list(task.download_urls)[0]['filename'],'a_filename')
 
+    def test_job_last_run_fields(self):
+        now = timezone.now()
+        run1 = ExportRun.objects.create(
+            job=self.job,
+            user=self.user1,
+            status='RUNNING',
+            started_at=now
+        )
+        ExportTask.objects.create(run=run1, filesize_bytes=100)
+        run1.update_total_bytes()
+        run1.status = 'COMPLETED'
+        run1.finished_at = now + datetime.timedelta(0,50)
+        run1.save()
+        run2 = ExportRun.objects.create(
+            job=self.job,
+            user=self.user1,
+            status='SUBMITTED'
+        )
+        # an older run finishing late leaves the newest one in place
+        run1.hdx_sync_status = True
+        run1.save()
 
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.last_run, run2)
+        self.assertEqual(self.job.last_run_status, 'SUBMITTED')
+        self.assertEqual(self.job.last_run_duration, 50)
+        self.assertEqual(self.job.last_run_size, 100)
 
+    def test_update_total_bytes(self):
+        run = ExportRun.objects.create(
+            job=self.job,
+            user=self.user1
+        )
+        ExportTask.objects.create(run=run, filesize_bytes=100)
+        ExportTask.objects.create(run=run, filesize_bytes=None)
+        ExportTask.objects.create(run=run, filesize_bytes=23)
+        run.update_total_bytes()
+        self.assertEqual(run.size, 123)
+        self.assertEqual(ExportRun.objects.get(id=run.id).total_bytes, 123)
+
+    def test_stored_download_urls(self):
+        run = ExportRun.objects.create(
+            job=self.job,
+            user=self.user1
+        )
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'TestJob_gpkg.zip')
+        with open(path, 'wb') as f:
+            f.write(b'abc')
+        remote = {
+            'download_url': 'https://example.com/exports/Liberia_buildings_uid_1234.zip',
+            'zip_file_size_bytes': 42,
+            'md5': '900150983cd24fb0d6963f7d28e17f72',
+        }
+        task = ExportTask.objects.create(
+            run=run,
+            files=[local_file(run.uid, path), raw_data_file(remote)]
+        )
+        os.remove(path)
+        local, raw = task.download_urls
+        self.assertEqual(local['download_url'], settings.EXPORT_MEDIA_ROOT + str(run.uid) + '/TestJob_gpkg.zip')
+        self.assertEqual(local['filesize_bytes'], 3)
+        self.assertIsNone(local['checksum'])
+        self.assertEqual(raw['filename'], 'Liberia_buildings.zip')
+        self.assertEqual(raw['filesize_bytes'], 42)
+        self.assertEqual(raw['checksum'], '900150983cd24fb0d6963f7d28e17f72')
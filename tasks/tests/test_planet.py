@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+import osmium
+from django.test import SimpleTestCase, override_settings
+from shapely.geometry import box
+
+from ..planet import apply_handler, has_locations_on_ways, planet_file_for, planet_sequence
+
+
+def write_pbf(path, file_format="pbf", sequence=None):
+    header = osmium.io.Header()
+    if sequence is not None:
+        header.set("osmosis_replication_sequence_number", str(sequence))
+    writer = osmium.io.Writer(osmium.io.File(path, file_format), header)
+    writer.close()
+    return path
+
+
+class TestPlanetFileFor(SimpleTestCase):
+    def setUp(self):
+        self.shards_dir = tempfile.mkdtemp()
+        self.index = os.path.join(self.shards_dir, "index.json")
+        shards = [
+            {"name": "africa", "path": "africa.osm.pbf", "bbox": [-27, -47, 64, 38]},
+            {"name": "LR", "path": "LR.osm.pbf", "bbox": [-11.6, 4.3, -7.3, 8.6]},
+            {"name": "missing", "path": "missing.osm.pbf", "bbox": [-11, 6, -10, 7]},
+        ]
+        for shard in shards[:2]:
+            open(os.path.join(self.shards_dir, shard["path"]), "w").close()
+        with open(self.index, "w") as f:
+            json.dump({"sequence": 1, "shards": shards}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.shards_dir)
+
+    def test_smallest_covering_shard(self):
+        with override_settings(PLANET_FILE="planet.osm.pbf", PLANET_SHARDS_INDEX=self.index):
+            monrovia = box(-10.81, 6.32, -10.79, 6.33)
+            self.assertEqual(
+                planet_file_for(monrovia), os.path.join(self.shards_dir, "LR.osm.pbf")
+            )
+            dakar = box(-17.5, 14.7, -17.4, 14.8)
+            self.assertEqual(
+                planet_file_for(dakar), os.path.join(self.shards_dir, "africa.osm.pbf")
+            )
+            lima = box(-77.1, -12.1, -77.0, -12.0)
+            self.assertEqual(planet_file_for(lima), "planet.osm.pbf")
+
+    def test_shards_behind_planet(self):
+        planet = write_pbf(os.path.join(self.shards_dir, "planet.osm.pbf"), sequence=2)
+        self.assertEqual(planet_sequence(planet), 2)
+        monrovia = box(-10.81, 6.32, -10.79, 6.33)
+        with override_settings(PLANET_FILE=planet, PLANET_SHARDS_INDEX=self.index):
+            self.assertEqual(planet_file_for(monrovia), planet)
+
+        planet = write_pbf(os.path.join(self.shards_dir, "current.osm.pbf"), sequence=1)
+        with override_settings(PLANET_FILE=planet, PLANET_SHARDS_INDEX=self.index):
+            self.assertEqual(
+                planet_file_for(monrovia), os.path.join(self.shards_dir, "LR.osm.pbf")
+            )
+
+    def test_no_index(self):
+        with override_settings(PLANET_FILE="planet.osm.pbf", PLANET_SHARDS_INDEX=""):
+            self.assertEqual(planet_file_for(box(0, 0, 1, 1)), "planet.osm.pbf")
+
+
+class TestLocationsOnWays(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_detects_locations_on_ways(self):
+        plain = write_pbf(os.path.join(self.tmpdir, "plain.osm.pbf"))
+        low = write_pbf(os.path.join(self.tmpdir, "low.osm.pbf"), "pbf,locations_on_ways=true")
+        self.assertFalse(has_locations_on_ways(plain))
+        self.assertTrue(has_locations_on_ways(low))
+        self.assertFalse(has_locations_on_ways(os.path.join(self.tmpdir, "missing.pbf")))
+
+
+class AreaCounter(osmium.SimpleHandler):
+    def __init__(self):
+        super().__init__()
+        self.areas = 0
+        self.located_ways = 0
+
+    def way(self, w):
+        self.located_ways += all(node.location.valid() for node in w.nodes)
+
+    def area(self, a):
+        self.areas += 1
+
+
+class TestApplyHandler(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_no_location_index(self):
+        # a closed way carrying its node locations, without the nodes: a
+        # node location index would have no location to give it
+        path = os.path.join(self.tmpdir, "low.osm")
+        corners = [(1, 0.0, 0.0), (2, 0.0, 1.0), (3, 1.0, 1.0), (1, 0.0, 0.0)]
+        with open(path, "w") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n'
+                '<way id="10" version="1">{0}<tag k="building" v="yes"/></way>\n'
+                "</osm>\n".format(
+                    "".join(
+                        '<nd ref="{0}" lon="{1}" lat="{2}"/>'.format(*c) for c in corners
+                    )
+                )
+            )
+        handler = AreaCounter()
+        apply_handler(handler, path, locations=False)
+        self.assertEqual(handler.located_ways, 1)
+        self.assertEqual(handler.areas, 1)
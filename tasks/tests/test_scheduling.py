@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from jobs.models import Job
+from feature_selection.feature_selection import FeatureSelection
+
+from ..models import ExportRun
+from ..scheduling import estimate_durations, plan_delays, scheduled_backlog
+
+
+class Region(object):
+    def __init__(self, job_id, delta=None, job=None):
+        self.job_id = job_id
+        self.delta = delta
+        self.job = job
+
+
+class TestEstimateDurations(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="user1", email="user1@demo.com", password="demo")
+        self.small = self.create_job("small", (0, 0, 1, 1))
+        self.large = self.create_job("large", (0, 0, 2, 2))
+
+    def create_job(self, name, bbox):
+        return Job.objects.create(
+            name=name,
+            user=self.user,
+            the_geom=Polygon.from_bbox(bbox),
+            export_formats=["shp"],
+            feature_selection=FeatureSelection.example("simple"),
+        )
+
+    def test_estimates_from_area(self):
+        now = timezone.now()
+        for minutes in [10, 20]:
+            ExportRun.objects.create(
+                job=self.small,
+                user=self.user,
+                status="COMPLETED",
+                started_at=now,
+                finished_at=now + timedelta(minutes=minutes),
+            )
+        regions = [Region(job.id, job=job) for job in [self.small, self.large]]
+        durations = estimate_durations(regions)
+        self.assertEqual(durations[self.small.id], 15 * 60)
+        # about four times the area of the small job
+        self.assertAlmostEqual(durations[self.large.id], 60 * 60, delta=5)
+
+    def test_backlog_counts_the_scheduled_queue(self):
+        for queue_name in ["scheduled", "default"]:
+            ExportRun.objects.create(
+                job=self.small, user=self.user, status="SUBMITTED", queue_name=queue_name
+            )
+        ExportRun.objects.create(
+            job=self.large, user=self.user, status="COMPLETED", queue_name="scheduled"
+        )
+        self.assertEqual(scheduled_backlog(), [3600])
+
+
+class TestPlanDelays(SimpleTestCase):
+    def test_runs_follow_each_other_on_one_worker(self):
+        regions = [Region(1, timedelta(days=1)), Region(2, timedelta(days=1)), Region(3, timedelta(days=1))]
+        plan = plan_delays(regions, {1: 600, 2: 1200, 3: 60}, 1, 6 * 3600)
+        self.assertEqual([delay for _, delay in plan], [0, 600, 1800])
+
+    def test_backlog_and_workers(self):
+        regions = [Region(1, timedelta(days=1)), Region(2, timedelta(days=1))]
+        plan = plan_delays(regions, {1: 600, 2: 600}, 2, 6 * 3600, backlog=[300])
+        self.assertEqual([delay for _, delay in plan], [0, 300])
+
+    def test_delay_keeps_window(self):
+        regions = [Region(1, timedelta(days=1)), Region(2, timedelta(hours=6)), Region(3, timedelta(days=1))]
+        plan = plan_delays(regions, {1: 5 * 3600, 2: 3600, 3: 3600}, 1, 4 * 3600)
+        # the worker is busy for 5 hours, but no run waits longer than the window
+        self.assertEqual([delay for _, delay in plan], [0, 4 * 3600, 4 * 3600])
+
+    def test_delay_keeps_period(self):
+        regions = [Region(1, timedelta(days=1)), Region(2, timedelta(hours=6))]
+        plan = plan_delays(regions, {1: 5 * 3600, 2: 3 * 3600}, 1, 12 * 3600)
+        # the 6 hourly region must start within 3 hours to finish before its next run
+        self.assertEqual([delay for _, delay in plan], [0, 3 * 3600])
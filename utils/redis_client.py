@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""The Redis client shared by download counting, upstream freshness and geocoding."""
+import redis
+from django.conf import settings
+
+# connections are opened on first use and pooled, so every caller shares
+# this client, forked workers included
+redis_client = redis.Redis.from_url(settings.REDIS_URL)
+
+
+def get_client():
+    return redis_client
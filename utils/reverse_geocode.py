@@ -0,0 +1,33 @@
+"""
+The GeoNames place nearest to a point, from the R-tree in
+api/reverse_geocode.* built by jobs/parse_rtree.py.
+"""
+import os
+
+from rtree import index
+
+INDEX_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api", "reverse_geocode"
+)
+
+_index = None
+
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = index.Rtree(INDEX_PATH)
+    return _index
+
+
+def nearest_place(x, y):
+    """[name, admin_1, country code] of the place nearest to (x, y), or None."""
+    result = next(get_index().nearest((x, y), 1, objects=True), None)
+    return result.object if result else None
+
+
+def country_code(geom):
+    """ISO code of the country of the place nearest to geom's centroid."""
+    centroid = geom.centroid
+    place = nearest_place(centroid.x, centroid.y)
+    return place[2] if place else ""